@@ -29,3 +29,8 @@ IF %ERRORLEVEL% NEQ 0 exit /B 1
 # Set up the perl libraries
 cp -ra lib\perl5\* %PREFIX%\lib\perl5\site_perl\
 IF %ERRORLEVEL% NEQ 0 exit /B 1
+
+# Copy shared python modules to the site-packages path
+if not exist %SP_DIR%\ mkdir %SP_DIR%\
+cp -ra lib\python\* %SP_DIR%\
+IF %ERRORLEVEL% NEQ 0 exit /B 1
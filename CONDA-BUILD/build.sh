@@ -13,3 +13,7 @@ cp -ra vcf-tools/*       "$PREFIX/bin/"
 
 # Copy required perl modules to the site_perl path
 cp -ra lib/perl5/* "$PREFIX/lib/perl5/site_perl/"
+
+# Copy shared python modules to the site-packages path
+mkdir -p "$SP_DIR"
+cp -ra lib/python/* "$SP_DIR/"
@@ -0,0 +1,39 @@
+"""
+Shared Python helpers for the omics-toolkit scripts.
+
+The scripts in ngs-tools/ import from here; install by putting lib/python on
+PYTHONPATH (github checkout) or via the conda package (site-packages).
+"""
+
+from .annotation import (
+    open_text,
+    GTFRecord,
+    GFFRecord,
+    BED12Record,
+    Transcript,
+    UnsortedGTFError,
+    read_gtf,
+    read_gff,
+    read_gff_sequences,
+    read_bed12,
+    gtf_transcripts,
+    gtf_stream_problem,
+)
+from .extsort import ExternalSorter, RunFiles
+
+__all__ = [
+    'open_text',
+    'GTFRecord',
+    'GFFRecord',
+    'BED12Record',
+    'Transcript',
+    'UnsortedGTFError',
+    'read_gtf',
+    'read_gff',
+    'read_gff_sequences',
+    'read_bed12',
+    'gtf_transcripts',
+    'gtf_stream_problem',
+    'ExternalSorter',
+    'RunFiles',
+]
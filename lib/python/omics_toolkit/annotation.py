@@ -0,0 +1,420 @@
+"""
+Streaming readers for GTF, GFF3 and BED12 annotation files.
+
+All readers accept plain or gzip/bgzip compressed input (detected from the
+magic bytes) and '-' for stdin. Records keep the raw attribute column and only
+decode the attributes that are asked for, using precompiled patterns.
+"""
+
+import gzip
+import io
+import re
+import sys
+
+
+#############
+# FILE I/O  #
+#############
+
+def open_binary(path):
+    """Open a plain or gzip/bgzip compressed file for binary reads ('-' reads stdin)."""
+    if path == '-':
+        raw = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        raw = open(path, 'rb')
+    stream = raw if hasattr(raw, 'peek') else io.BufferedReader(raw)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def open_text(path):
+    """Open a plain or gzip/bgzip compressed text file ('-' reads stdin)."""
+    return io.TextIOWrapper(open_binary(path))
+
+
+##############
+# ATTRIBUTES #
+##############
+
+_GTF_ATTR_PATTERNS = {}
+
+
+def _gtf_attr_patterns(key):
+    """Compiled (double quoted, single quoted) value patterns for a GTF attribute."""
+    pats = _GTF_ATTR_PATTERNS.get(key)
+    if pats is None:
+        k = re.escape(key)
+        pats = (re.compile(k + r'\s+"([^"]+)"'), re.compile(k + r"\s+'([^']+)'"))
+        _GTF_ATTR_PATTERNS[key] = pats
+    return pats
+
+
+_EXON_NUMBER_RE = re.compile(r'exon_number\s+"?(\d+)"?')
+_GTF_PAIR_RE = re.compile(r'\s*([^\s;]+)\s+(?:"([^"]*)"|\'([^\']*)\'|([^;]*?))\s*(?:;|$)')
+
+
+def gtf_attr(attrs, key):
+    """
+    Value of a GTF attribute from the raw attribute column, or None.
+    Matches `key "value"` first and `key 'value'` second, like the
+    original per-script re.search() calls.
+    """
+    i = attrs.find(key)
+    if i < 0:
+        return None
+    # Fast path: the first occurrence of key is written as  key "value"
+    j = i + len(key)
+    if attrs.startswith(' "', j):
+        k = attrs.find('"', j + 2)
+        if k > j + 2:
+            return attrs[j + 2:k]
+    dq, sq = _gtf_attr_patterns(key)
+    m = dq.search(attrs) or sq.search(attrs)
+    return m.group(1) if m else None
+
+
+###########
+# RECORDS #
+###########
+
+class GTFRecord(object):
+    """One GTF line; coordinates are 1-based inclusive, attributes decoded on demand."""
+
+    __slots__ = ('chrom', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attrs', '_attributes')
+
+    def __init__(self, chrom, source, feature, start, end, score, strand, frame, attrs):
+        self.chrom = chrom
+        self.source = source
+        self.feature = feature
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.frame = frame
+        self.attrs = attrs
+        self._attributes = None
+
+    def get(self, key, default=None):
+        """Value of a single attribute without decoding the rest of the column."""
+        value = gtf_attr(self.attrs, key)
+        return default if value is None else value
+
+    @property
+    def attributes(self):
+        """All attributes as a dict (decoded once, on first access)."""
+        if self._attributes is None:
+            parsed = {}
+            for m in _GTF_PAIR_RE.finditer(self.attrs):
+                value = next((g for g in m.groups()[1:] if g is not None), '')
+                parsed.setdefault(m.group(1), value)
+            self._attributes = parsed
+        return self._attributes
+
+    @property
+    def transcript_id(self):
+        return gtf_attr(self.attrs, 'transcript_id')
+
+    @property
+    def gene_id(self):
+        return gtf_attr(self.attrs, 'gene_id')
+
+    @property
+    def exon_number(self):
+        m = _EXON_NUMBER_RE.search(self.attrs)
+        return int(m.group(1)) if m else None
+
+
+class GFFRecord(object):
+    """One GFF3 line; coordinates are 1-based inclusive, attributes decoded on demand."""
+
+    __slots__ = ('chrom', 'source', 'feature', 'start', 'end', 'score', 'strand', 'phase', 'attrs', '_attributes')
+
+    def __init__(self, chrom, source, feature, start, end, score, strand, phase, attrs):
+        self.chrom = chrom
+        self.source = source
+        self.feature = feature
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.phase = phase
+        self.attrs = attrs
+        self._attributes = None
+
+    @property
+    def attributes(self):
+        """All key=value attributes as a dict; values are kept undecoded."""
+        if self._attributes is None:
+            parsed = {}
+            for item in self.attrs.split(';'):
+                if '=' in item:
+                    key, value = item.split('=', 2)[:2]
+                    parsed[key] = value
+            self._attributes = parsed
+        return self._attributes
+
+    def get(self, key, default=None):
+        return self.attributes.get(key, default)
+
+
+class BED12Record(object):
+    """One BED12 line; coordinates are 0-based half-open, blocks decoded on demand."""
+
+    __slots__ = ('chrom', 'start', 'end', 'name', 'strand', 'fields')
+
+    def __init__(self, fields):
+        self.chrom = fields[0]
+        self.start = int(fields[1])
+        self.end = int(fields[2])
+        self.name = fields[3]
+        self.strand = fields[5]
+        self.fields = fields
+
+    def exons_1b(self):
+        """
+        Blocks as sorted (start, end) 1-based inclusive exons, or None when
+        blockCount does not match the sizes/starts lists.
+        """
+        block_count = int(self.fields[9])
+        block_sizes = [int(x) for x in self.fields[10].rstrip(',').split(',')]
+        block_starts = [int(x) for x in self.fields[11].rstrip(',').split(',')]
+        if len(block_sizes) != block_count or len(block_starts) != block_count:
+            return None
+        exons = [(self.start + bstart + 1, self.start + bstart + bs)
+                 for bs, bstart in zip(block_sizes, block_starts)]
+        return sorted(exons, key=lambda x: x[0])
+
+
+class Transcript(object):
+    """Exons of one GTF transcript in file order, with strand and gene_id of its first exons."""
+
+    __slots__ = ('chrom', 'txid', 'strand', 'gene_id', 'exons', 'max_end')
+
+    def __init__(self, chrom, txid, strand, gene_id, start, end):
+        self.chrom = chrom
+        self.txid = txid
+        self.strand = strand
+        self.gene_id = gene_id
+        self.exons = [(start, end)]
+        self.max_end = end
+
+    def add(self, start, end, gene_id=None):
+        self.exons.append((start, end))
+        if end > self.max_end:
+            self.max_end = end
+        if self.gene_id is None:
+            self.gene_id = gene_id
+
+    @property
+    def min_start(self):
+        return min(s for s, _ in self.exons)
+
+
+class UnsortedGTFError(ValueError):
+    """Raised by gtf_transcripts(stream=True) when the GTF is neither grouped nor sorted."""
+
+
+###########
+# READERS #
+###########
+
+def _gtf_fields(path, features=None):
+    """Yield the 9 GTF columns of each data line as a list of strings."""
+    with open_text(path) as fh:
+        for line in fh:
+            if line[0] == '#':
+                continue
+            parts = line.split('\t', 8)
+            if len(parts) < 9:
+                continue
+            if features is not None and parts[2] not in features:
+                continue
+            attrs = parts[8].rstrip('\n')
+            parts[8] = attrs.split('\t', 1)[0] if '\t' in attrs else attrs
+            yield parts
+
+
+def read_gtf(path, features=None):
+    """
+    Yield GTFRecord objects from a GTF file, skipping comments and short lines.
+    features: optional set of feature types to keep; other lines are dropped
+    before any attribute work is done.
+    """
+    for chrom, source, feature, start, end, score, strand, frame, attrs in _gtf_fields(path, features):
+        yield GTFRecord(chrom, source, feature, int(start), int(end), score, strand, frame, attrs)
+
+
+def read_gff(path, features=None):
+    """
+    Yield GFFRecord objects from a GFF3 file. Reading stops at an embedded
+    FASTA section ('##FASTA' or the first '>' header); see read_gff_sequences().
+    """
+    with open_text(path) as fh:
+        for line in fh:
+            if line.startswith('>') or line.startswith('##FASTA'):
+                break
+            if line.startswith('#'):
+                continue
+            parts = line.rstrip().split('\t')
+            if len(parts) < 9:
+                continue
+            if features is not None and parts[2] not in features:
+                continue
+            chrom, source, feature, start, end, score, strand, phase, attrs = parts[:9]
+            yield GFFRecord(chrom, source, feature, int(start), int(end), score, strand, phase, attrs)
+
+
+def read_gff_sequences(path):
+    """Return {name: sequence} from the FASTA section embedded in a GFF3 file."""
+    seqs = {}
+    name = None
+    chunks = []
+    with open_text(path) as fh:
+        for line in fh:
+            if line.startswith('>'):
+                if name is not None:
+                    seqs[name] = ''.join(chunks)
+                name = line.split()[0][1:]
+                chunks = []
+            elif name is not None and not line.startswith('#'):
+                chunks.append(line.rstrip())
+    if name is not None:
+        seqs[name] = ''.join(chunks)
+    return seqs
+
+
+def read_bed12(path):
+    """Yield BED12Record objects, skipping comment/track/browser lines and lines with < 12 columns."""
+    with open_text(path) as fh:
+        for line in fh:
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 12:
+                continue
+            yield BED12Record(parts)
+
+
+def _transcript_id(feature, attrs, exonset_needs_number):
+    """transcript_id, or '<gene_id>:exonset' for exons without one."""
+    txid = gtf_attr(attrs, 'transcript_id')
+    if txid is not None:
+        return txid
+    if feature != 'exon':
+        return None
+    gene_id = gtf_attr(attrs, 'gene_id')
+    if gene_id is None or (exonset_needs_number and not _EXON_NUMBER_RE.search(attrs)):
+        return None
+    return f"{gene_id}:exonset"
+
+
+def gtf_stream_problem(path, max_rows=100000, exonset_needs_number=True):
+    """
+    Look at the first max_rows exon/transcript lines of a GTF and return why
+    gtf_transcripts(stream=True) would fail on it, or None if it looks
+    streamable. The exons of a transcript without a preceding 'transcript'
+    record (including '<gene_id>:exonset' groups) have to be consecutive: in a
+    position-sorted GTF any other exon inside one of its introns completes it
+    too early.
+    """
+    spanned = set()
+    seen = set()
+    previous = None
+    for n, (chrom, _, feature, _, _, _, _, _, attrs) in enumerate(_gtf_fields(path, features=('exon', 'transcript'))):
+        if n >= max_rows:
+            break
+        txid = _transcript_id(feature, attrs, exonset_needs_number)
+        if txid is None:
+            continue
+        key = (chrom, txid)
+        if feature == 'transcript':
+            spanned.add(key)
+            continue
+        if key != previous:
+            if key in seen and key not in spanned:
+                return (f"the exons of {txid} are not consecutive and have no 'transcript' record "
+                        f"(the GTF is not grouped by transcript)")
+            seen.add(key)
+            previous = key
+    return None
+
+
+def gtf_transcripts(path, stream=False, gene_ids=False, exonset_needs_number=True):
+    """
+    Group the exons of a GTF into Transcript objects, yielded in order of each
+    transcript's first exon. Exons without a transcript_id are grouped per gene
+    as '<gene_id>:exonset' (only when they carry an exon_number if
+    exonset_needs_number). gene_ids: also record the first gene_id seen.
+
+    stream=False holds every transcript until the end of the file.
+    stream=True expects a GTF grouped by transcript, or sorted by chrom and
+    position with 'transcript' records (a sorted exon-only GTF practically
+    always fails; see gtf_stream_problem()): a transcript is flushed once a
+    record of another transcript on the same chromosome starts past its end
+    (from its 'transcript' record when present, else its last exon), or when
+    the chromosome changes. Only the
+    oldest open transcript is checked, so the output order is the same as the
+    in-memory mode. Raises UnsortedGTFError if an exon turns up for a
+    transcript that was already flushed; only hashes of flushed ids are kept
+    for that (a hash collision merely raises needlessly).
+    """
+    rows = _gtf_fields(path, features=('exon', 'transcript') if stream else ('exon',))
+    if not stream:
+        txs = {}
+        for chrom, _, feature, start, end, _, strand, _, attrs in rows:
+            txid = _transcript_id(feature, attrs, exonset_needs_number)
+            if txid is None:
+                continue
+            gene_id = gtf_attr(attrs, 'gene_id') if gene_ids else None
+            tx = txs.get((chrom, txid))
+            if tx is None:
+                txs[(chrom, txid)] = Transcript(chrom, txid, strand, gene_id, int(start), int(end))
+            else:
+                tx.add(int(start), int(end), gene_id)
+        yield from txs.values()
+        return
+
+    open_tx = {}      # txid -> Transcript, in first-seen order
+    spans = {}        # txid -> transcript end from 'transcript' records
+    flushed = set()   # hash((chrom, txid)) of transcripts already yielded
+    cur_chrom = None
+
+    def flush(txid):
+        spans.pop(txid, None)
+        flushed.add(hash((cur_chrom, txid)))
+        return open_tx.pop(txid)
+
+    for chrom, _, feature, start, end, _, strand, _, attrs in rows:
+        txid = _transcript_id(feature, attrs, exonset_needs_number)
+        if txid is None:
+            continue
+        s = int(start)
+        e = int(end)
+        if chrom != cur_chrom:
+            while open_tx:
+                yield flush(next(iter(open_tx)))
+            spans.clear()
+            cur_chrom = chrom
+        else:
+            while open_tx:
+                head = next(iter(open_tx))
+                if head == txid or s <= max(open_tx[head].max_end, spans.get(head, 0)):
+                    break
+                yield flush(head)
+
+        if hash((chrom, txid)) in flushed:
+            if feature == 'exon':
+                raise UnsortedGTFError(f"exon for transcript {txid} found after it was completed")
+            continue
+        if feature == 'transcript':
+            spans[txid] = max(e, spans.get(txid, 0))
+            continue
+        gene_id = gtf_attr(attrs, 'gene_id') if gene_ids else None
+        tx = open_tx.get(txid)
+        if tx is None:
+            open_tx[txid] = Transcript(chrom, txid, strand, gene_id, s, e)
+        else:
+            tx.add(s, e, gene_id)
+    while open_tx:
+        yield flush(next(iter(open_tx)))
@@ -0,0 +1,57 @@
+"""
+Text output that is bgzip compressed when the path ends in .gz.
+
+BGZF is plain gzip to every reader and can be tabix indexed. Compression runs
+in htslib's bgzip with -@ threads when bgzip is on PATH, otherwise in-process
+(single-threaded) through pysam.
+"""
+
+import io
+import shutil
+import subprocess
+
+
+def is_gzip_path(path):
+    return str(path).endswith('.gz')
+
+
+class _BgzipPipe(io.TextIOWrapper):
+    """Text writer feeding `bgzip -c -@ threads` into path; close() checks its exit status."""
+
+    def __init__(self, bgzip, path, threads):
+        self._path = path
+        self._dest = open(path, 'wb')
+        self._proc = subprocess.Popen([bgzip, '-c', '-@', str(max(1, threads))],
+                                      stdin=subprocess.PIPE, stdout=self._dest)
+        super().__init__(self._proc.stdin)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            status = self._proc.wait()
+            self._dest.close()
+        if status != 0:
+            raise OSError(f"bgzip exited with status {status} while writing {self._path}")
+
+
+def open_output(path, threads=1):
+    """
+    Open path for text writing; paths ending in .gz are BGZF compressed with
+    up to threads compression threads.
+    """
+    if not is_gzip_path(path):
+        return open(path, 'w')
+    bgzip = shutil.which('bgzip')
+    if bgzip:
+        return _BgzipPipe(bgzip, str(path), threads)
+    import pysam
+    return io.TextIOWrapper(pysam.BGZFile(str(path), 'wb'))
+
+
+def tabix_index_bed(path):
+    """Write path.tbi for a BGZF compressed BED file sorted by chrom and start."""
+    import pysam
+    return pysam.tabix_index(str(path), preset='bed', force=True, keep_original=True)
@@ -0,0 +1,198 @@
+"""
+Columnar GTF engine for GENCODE-scale annotations.
+
+Exon lines are read in chunks with pyarrow.csv (or the pandas C parser when
+pyarrow is not installed) and transcript_id / gene_id / exon_number are
+extracted with vectorized regexes, so no Python code runs per line.
+Transcripts come out as grouped arrays (one row per exon, a transcript code
+per row) in the same first-seen order as gtf_transcripts().
+"""
+
+import csv
+import re
+
+import numpy as np
+import pandas as pd
+
+from .annotation import open_binary, open_text
+
+
+GTF_COLUMNS = ['chrom', 'source', 'feature', 'start', 'end', 'score', 'strand', 'frame', 'attrs']
+
+# pyarrow.csv + RE2 when available, else the pandas C parser with Series.str regexes
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+
+def _arrow_chunks(path, chunksize):
+    """Yield (chrom, strand, start, end, attrs) exon columns per block; attrs stays an arrow array."""
+    read_opts = pa_csv.ReadOptions(column_names=GTF_COLUMNS, block_size=max(chunksize * 100, 1 << 20))
+    parse_opts = pa_csv.ParseOptions(delimiter='\t', quote_char=False, escape_char=False,
+                                     invalid_row_handler=lambda row: 'skip')
+    convert_opts = pa_csv.ConvertOptions(include_columns=['chrom', 'feature', 'start', 'end', 'strand', 'attrs'],
+                                         column_types={c: pa.string() for c in GTF_COLUMNS},
+                                         strings_can_be_null=False)
+    with open_binary(path) as fh:
+        if not fh.peek(1):
+            return
+        reader = pa_csv.open_csv(fh, read_options=read_opts, parse_options=parse_opts, convert_options=convert_opts)
+        for batch in reader:
+            keep = pc.and_(pc.equal(batch['feature'], 'exon'),
+                           pc.invert(pc.starts_with(batch['chrom'], '#')))
+            batch = batch.filter(keep)
+            yield (batch['chrom'].to_numpy(zero_copy_only=False),
+                   batch['strand'].to_numpy(zero_copy_only=False),
+                   pc.cast(batch['start'], pa.int64()).to_numpy(),
+                   pc.cast(batch['end'], pa.int64()).to_numpy(),
+                   batch['attrs'])
+
+
+def _arrow_extract(attrs, pattern, rows=None):
+    """First capture group of pattern per row (None when absent)."""
+    if rows is not None:
+        attrs = attrs.take(pa.array(rows, type=pa.int64()))
+    pattern = pattern.replace('(', '(?P<v>', 1)
+    return pc.struct_field(pc.extract_regex(attrs, pattern), [0]).to_numpy(zero_copy_only=False)
+
+
+def _arrow_matches(attrs, pattern, rows):
+    return pc.match_substring_regex(attrs.take(pa.array(rows, type=pa.int64())), pattern).to_numpy(zero_copy_only=False)
+
+
+def _pandas_chunks(path, chunksize):
+    """Yield (chrom, strand, start, end, attrs) exon columns per chunk; attrs stays a Series."""
+    with open_text(path) as fh:
+        reader = pd.read_csv(
+            fh, sep='\t', header=None, names=GTF_COLUMNS,
+            dtype=str, na_filter=False, quoting=csv.QUOTE_NONE, on_bad_lines='skip',
+            engine='c', chunksize=chunksize
+        )
+        for df in reader:
+            # Short lines come back with empty fields: drop rows whose start/end
+            # are not numbers (the python and pyarrow readers skip those lines)
+            numeric = df['start'].str.fullmatch(r'\d+') & df['end'].str.fullmatch(r'\d+')
+            df = df[(df['feature'] == 'exon') & ~df['chrom'].str.startswith('#') & numeric]
+            yield (df['chrom'].to_numpy(dtype=object),
+                   df['strand'].to_numpy(dtype=object),
+                   df['start'].to_numpy().astype(np.int64),
+                   df['end'].to_numpy().astype(np.int64),
+                   df['attrs'].reset_index(drop=True))
+
+
+def _pandas_extract(attrs, pattern, rows=None):
+    if rows is not None:
+        attrs = attrs.iloc[rows]
+    return attrs.str.extract(pattern, expand=False).to_numpy(dtype=object, na_value=None)
+
+
+def _pandas_matches(attrs, pattern, rows):
+    return attrs.iloc[rows].str.contains(pattern, regex=True).to_numpy(dtype=bool)
+
+
+def _attr_patterns(key):
+    k = re.escape(key)
+    return k + r'\s+"([^"]+)"', k + r"\s+'([^']+)'"
+
+
+def _extract_attr(extract, attrs, key, rows=None):
+    """Vectorized gtf_attr(): `key "value"` first, single quotes only where that is missing."""
+    dq, sq = _attr_patterns(key)
+    values = extract(attrs, dq, rows)
+    missing = np.flatnonzero(pd.isna(values))
+    if len(missing):
+        sub = missing if rows is None else np.asarray(rows)[missing]
+        values[missing] = extract(attrs, sq, sub)
+    return values
+
+
+def gtf_exon_table(path, gene_ids=False, exonset_needs_number=True, chunksize=1_000_000):
+    """
+    Read the exon lines of a GTF into a DataFrame with columns
+    chrom, txid, strand, start, end (1-based inclusive, int64) and, with
+    gene_ids, gene_id (None when absent). Rows are in file order; exons without
+    a transcript_id get '<gene_id>:exonset' like gtf_transcripts().
+    chunksize: approximate number of lines parsed per chunk.
+    """
+    if pa is not None:
+        chunks, extract, matches = _arrow_chunks(path, chunksize), _arrow_extract, _arrow_matches
+    else:
+        chunks, extract, matches = _pandas_chunks(path, chunksize), _pandas_extract, _pandas_matches
+
+    tables = []
+    for chrom, strand, start, end, attrs in chunks:
+        txid = _extract_attr(extract, attrs, 'transcript_id')
+        gene_id = _extract_attr(extract, attrs, 'gene_id') if gene_ids else None
+        missing = np.flatnonzero(pd.isna(txid))
+        if len(missing):
+            genes = gene_id[missing] if gene_ids else _extract_attr(extract, attrs, 'gene_id', missing)
+            ok = ~pd.isna(genes)
+            if exonset_needs_number and ok.any():
+                ok[ok] = matches(attrs, r'exon_number\s+"?\d', missing[ok])
+            txid[missing[ok]] = [f"{g}:exonset" for g in genes[ok]]
+        keep = ~pd.isna(txid)
+        table = pd.DataFrame({
+            'chrom': chrom[keep],
+            'txid': txid[keep],
+            'strand': strand[keep],
+            'start': start[keep],
+            'end': end[keep],
+        })
+        if gene_ids:
+            table['gene_id'] = gene_id[keep]
+        tables.append(table)
+    if not tables:
+        cols = ['chrom', 'txid', 'strand', 'start', 'end'] + (['gene_id'] if gene_ids else [])
+        return pd.DataFrame({c: np.empty(0, dtype=np.int64 if c in ('start', 'end') else object) for c in cols})
+    return pd.concat(tables, ignore_index=True)
+
+
+def transcript_codes(exons):
+    """Transcript index per exon row, numbered in order of first appearance."""
+    return exons.groupby(['chrom', 'txid'], sort=False).ngroup().to_numpy()
+
+
+def gtf_transcript_table(path, gene_ids=False, exonset_needs_number=True, chunksize=1_000_000):
+    """
+    Per-transcript bounds from a GTF: DataFrame with chrom, txid, strand (of the
+    first exon), min_start_1b, max_end_1b and, with gene_ids, the first gene_id
+    seen. Rows are in order of each transcript's first exon.
+    """
+    exons = gtf_exon_table(path, gene_ids=gene_ids, exonset_needs_number=exonset_needs_number,
+                           chunksize=chunksize)
+    grouped = exons.groupby(transcript_codes(exons), sort=True)
+    agg = {'chrom': 'first', 'txid': 'first', 'strand': 'first', 'start': 'min', 'end': 'max'}
+    if gene_ids:
+        agg['gene_id'] = 'first'
+    table = grouped.agg(agg).rename(columns={'start': 'min_start_1b', 'end': 'max_end_1b'})
+    return table.reset_index(drop=True)
+
+
+def gtf_intron_table(path, exonset_needs_number=True, chunksize=1_000_000):
+    """
+    Introns of every GTF transcript as a DataFrame with chrom, strand, start,
+    end (1-based inclusive). Rows follow the transcript order of
+    gtf_transcripts() and, within a transcript, the start-sorted exon order, so
+    the result matches looping introns_from_exons() over parse_gtf().
+    """
+    exons = gtf_exon_table(path, exonset_needs_number=exonset_needs_number, chunksize=chunksize)
+    codes = transcript_codes(exons)
+    starts = exons['start'].to_numpy()
+    ends = exons['end'].to_numpy()
+
+    # Stable sort by (transcript, start): ties keep file order like sorted()
+    order = np.lexsort((starts, codes))
+    codes, starts, ends = codes[order], starts[order], ends[order]
+    intr_start = ends[:-1] + 1
+    intr_end = starts[1:] - 1
+    keep = np.flatnonzero((codes[1:] == codes[:-1]) & (intr_end >= intr_start))
+    rows = order[keep]
+    return pd.DataFrame({
+        'chrom': exons['chrom'].to_numpy()[rows],
+        'strand': exons['strand'].to_numpy()[rows],
+        'start': intr_start[keep],
+        'end': intr_end[keep],
+    })
@@ -0,0 +1,181 @@
+"""
+Memory-budgeted sorting for outputs that may not fit in memory.
+
+ExternalSorter buffers items, spills each full buffer as a sorted run to a
+temporary file and k-way merges the runs when iterated. The result equals
+sorted(items, key=key) with adjacent duplicates removed, whether or not
+anything was spilled. RunFiles keeps track of the spilled runs and merges
+them in rounds so that the number of runs, and of files open while merging
+them, stays small.
+"""
+
+import argparse
+import heapq
+import itertools
+import os
+import pickle
+import tempfile
+
+
+class RunFiles:
+    """
+    Sorted runs spilled to files in a temporary directory under tmpdir (made
+    on first use, removed by clear()). merge(paths, out_path) must write the
+    stable merge of the runs at paths to out_path. Runs are merged in levels:
+    max_runs consecutive runs of one level become one run of the next, so
+    paths stays in spill order and holds fewer than max_runs runs per level.
+    """
+
+    MAX_RUNS = 16
+
+    def __init__(self, merge, tmpdir=None, prefix='omics-extsort.', suffix='', max_runs=MAX_RUNS):
+        self.merge = merge
+        self.tmpdir = tmpdir
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_runs = max_runs
+        self.paths = []
+        self._levels = []
+        self._n_written = 0
+        self._dir = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def new_path(self):
+        """Path for the next run file."""
+        if self._dir is None:
+            self._dir = tempfile.TemporaryDirectory(prefix=self.prefix, dir=self.tmpdir)
+        self._n_written += 1
+        return os.path.join(self._dir.name, f"run{self._n_written:05d}{self.suffix}")
+
+    def add(self, path):
+        """Register the run written to path (from new_path()), merging full levels."""
+        self.paths.append(path)
+        self._levels.append(0)
+        level = 0
+        while self._levels[-self.max_runs:] == [level] * self.max_runs:
+            runs = self.paths[-self.max_runs:]
+            merged = self.new_path()
+            self.merge(runs, merged)
+            for run in runs:
+                os.remove(run)
+            self.paths[-self.max_runs:] = [merged]
+            self._levels[-self.max_runs:] = [level + 1]
+            level += 1
+
+    def clear(self):
+        """Remove all runs."""
+        self.paths = []
+        self._levels = []
+        if self._dir is not None:
+            self._dir.cleanup()
+            self._dir = None
+
+
+class ExternalSorter:
+    """
+    Collect items with append()/extend() and iterate them sorted by key and
+    de-duplicated. max_items: items held in memory before a run is spilled
+    (None: never spill). Items must be picklable. Runs live in a temporary
+    directory under tmpdir that is removed by clear()/close(); RunFiles merges
+    them in rounds as they accumulate.
+    """
+
+    def __init__(self, max_items=None, key=None, tmpdir=None, batch=10000):
+        self.max_items = max_items
+        self.key = key
+        self.tmpdir = tmpdir
+        # Merging holds one batch per run in memory
+        self.batch = batch if max_items is None else max(1, min(batch, max_items // RunFiles.MAX_RUNS))
+        self.n_items = 0
+        self._buffer = []
+        self._runs = RunFiles(self._merge_runs, tmpdir, suffix='.pkl')
+
+    def append(self, item):
+        self._buffer.append(item)
+        self.n_items += 1
+        if self.max_items is not None and len(self._buffer) >= self.max_items:
+            self._spill()
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    @property
+    def n_runs(self):
+        return len(self._runs)
+
+    def _write_run(self, items, path):
+        items = iter(items)
+        with open(path, 'wb') as fh:
+            while True:
+                chunk = list(itertools.islice(items, self.batch))
+                if not chunk:
+                    return
+                pickle.dump(chunk, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _spill(self):
+        self._buffer.sort(key=self.key)
+        path = self._runs.new_path()
+        self._write_run(self._buffer, path)
+        self._buffer = []
+        self._runs.add(path)
+
+    def _merge_runs(self, paths, out_path):
+        self._write_run(heapq.merge(*(self._read_run(p) for p in paths), key=self.key), out_path)
+
+    @staticmethod
+    def _read_run(path):
+        with open(path, 'rb') as fh:
+            while True:
+                try:
+                    chunk = pickle.load(fh)
+                except EOFError:
+                    return
+                yield from chunk
+
+    def __iter__(self):
+        # Both sorts are stable and heapq.merge prefers earlier runs on ties,
+        # so tied items keep their insertion order like sorted()
+        self._buffer.sort(key=self.key)
+        if self._runs:
+            merged = heapq.merge(*(self._read_run(p) for p in self._runs.paths), self._buffer, key=self.key)
+        else:
+            merged = iter(self._buffer)
+        previous = first = object()
+        for item in merged:
+            if previous is first or item != previous:
+                yield item
+            previous = item
+
+    def clear(self):
+        """Drop all items and spilled runs."""
+        self._buffer = []
+        self.n_items = 0
+        self._runs.clear()
+
+    close = clear
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def parse_size(value):
+    """argparse type for memory sizes like 500M or 4G, in bytes; plain numbers are MB."""
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = value.strip().upper().rstrip('B')
+    try:
+        if text and text[-1] in units:
+            size = float(text[:-1]) * units[text[-1]]
+        else:
+            size = float(text) * units['M']
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"size must be positive: {value!r}")
+    return int(size)
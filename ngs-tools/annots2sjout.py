@@ -10,10 +10,21 @@ import sys
 import argparse
 import logging
 import signal
-import re
+import multiprocessing
+import os
+import heapq
+import hashlib
+import sqlite3
+import numpy as np
 import pysam
 from pathlib import Path
-from collections import defaultdict, Counter
+from collections import defaultdict, deque, Counter
+
+# Shared annotation readers (lib/python in a git checkout)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'lib' / 'python'))
+from omics_toolkit.annotation import gtf_transcripts, gtf_stream_problem, read_bed12, UnsortedGTFError
+from omics_toolkit.extsort import ExternalSorter, RunFiles, parse_size
+from omics_toolkit.bgzf import open_output
 
 # Configure logging
 logging.basicConfig(
@@ -49,17 +60,21 @@ def parse_args():
             " 4 strand: 0=undef, 1='+', 2='-'\n"
             " 5 motif on genomic + strand: 1 GT/AG, 2 CT/AC, 3 GC/AG, 4 CT/GC, 5 AT/AC, 6 GT/AT, 0 non-canonical\n"
             " 6 annotated (here: always 1)\n"
-            " 7 uniquely mapping reads spanning junction (set via --uniq-reads)\n"
-            " 8 multi-mapping reads spanning junction (here: 0)\n"
-            " 9 maximum spliced overhang (here: 0)"
+            " 7 uniquely mapping reads spanning junction (set via --uniq-reads, or the number of\n"
+            "   input annotations containing the junction with --support-counts; counted with --bam)\n"
+            " 8 multi-mapping reads spanning junction (here: 0; counted with --bam)\n"
+            " 9 maximum spliced overhang (here: 0; counted with --bam)"
         )
     )
-    g = parser.add_mutually_exclusive_group(required=True)
-    g.add_argument('--gtf',    help='Input GTF with exon features.')
-    g.add_argument('--bed12',  help='Input BED12 with block structure (exons).')
+    # Inputs keep their command-line order across both options
+    parser.add_argument('--gtf',   dest='inputs', action='append', metavar='GTF', type=lambda p: ('gtf', p),
+                        help='Input GTF with exon features. Can be given multiple times.')
+    parser.add_argument('--bed12', dest='inputs', action='append', metavar='BED12', type=lambda p: ('bed12', p),
+                        help='Input BED12 with block structure (exons). Can be given multiple times.')
 
-    parser.add_argument('-o', '--out',        required=True,
-                        help='Output SJ.out.tab path.')
+    parser.add_argument('-o', '--out',        default=None,
+                        help='Output SJ.out.tab path (bgzip compressed if it ends in .gz). '
+                             'Required unless only maintaining the --motif-cache.')
     parser.add_argument('--ref-fasta',        required=True,
                         help='Reference FASTA (requires .fai index).')
     parser.add_argument('--fail',             default=None,
@@ -80,54 +95,112 @@ def parse_args():
              "'skip' drop the junction (default); 'zero' keep it with motif=0 (STAR non-canonical)."
     )
 
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="Stream the GTF instead of holding every exon in memory. Works for GTFs "
+             "grouped by transcript, or sorted by chrom and position with 'transcript' "
+             "records. Exon-only GTFs that are not grouped are detected up front and read "
+             "in memory; other unsorted input is detected part-way and re-read in memory."
+    )
+
+    parser.add_argument(
+        '--engine', choices=['python', 'columnar'], default='python',
+        help="GTF reader: 'python' parses line by line (default); 'columnar' reads the GTF "
+             "in chunks with pyarrow/pandas and derives introns with vectorized array "
+             "operations, which is much faster on GENCODE-scale annotations."
+    )
+
+    parser.add_argument(
+        '--bulk-fetch', action='store_true',
+        help="Load each chromosome once and compute all motifs on it with vectorized "
+             "indexing instead of two FASTA lookups per intron. Faster for large "
+             "annotations and references with many contigs; peak memory is bounded "
+             "by the largest chromosome."
+    )
+
+    parser.add_argument(
+        '--threads', type=int, default=1,
+        help="Worker processes. Transcripts are partitioned by chromosome and each worker "
+             "derives introns and computes motifs for its chromosomes with its own FASTA "
+             "handle. Output is identical to the serial run. Also used as bgzip compression "
+             "threads for .gz outputs. Default: 1."
+    )
+
+    parser.add_argument(
+        '--motif-cache', default=None, metavar='DB',
+        help="SQLite file caching motif codes and failure reasons per reference checksum and "
+             "(chrom, start, end). Later runs against the same FASTA only read it for "
+             "junctions not yet in the cache. Created if missing."
+    )
+    parser.add_argument(
+        '--rebuild-motif-cache', action='store_true',
+        help="Drop the cached motifs of this reference and derive them again (needs --motif-cache). "
+             "Without inputs only the cache is maintained and nothing else is done."
+    )
+    parser.add_argument(
+        '--prune-motif-cache', action='store_true',
+        help="Remove cached motifs of all other references and compact the cache file "
+             "(needs --motif-cache). Without inputs only the cache is maintained."
+    )
+
+    parser.add_argument(
+        '--max-memory', type=parse_size, default=None, metavar='SIZE',
+        help="Approximate memory budget for the collected introns, sorted output and failures "
+             "(e.g. 500M, 4G; plain numbers are MB). Sorted runs are spilled to --tmp-dir and "
+             "merged while annotating and on write; output is identical to the in-memory sort. "
+             "GTFs read in memory (without --stream) are not covered. Default: sort in memory."
+    )
+    parser.add_argument(
+        '--tmp-dir', default=None,
+        help="Directory for --max-memory sort runs. Default: system temporary directory."
+    )
+
     parser.add_argument(
         '--uniq-reads', type=int, default=100,
         help="Value to write into SJ.out.tab column 7 (unique spanning reads). "
              "Some downstream tools ignore junctions with 0. Default: 100."
     )
+    parser.add_argument(
+        '--support-counts', action='store_true',
+        help="Write the number of input annotations containing each junction into "
+             "column 7 instead of the constant --uniq-reads value."
+    )
+    parser.add_argument(
+        '--bam', action='append', default=[],
+        help="Indexed, coordinate-sorted BAM to count junction reads from; can be given multiple "
+             "times (counts are summed). Fills columns 7-9 with unique (NH==1) and multi-mapping "
+             "spliced reads (a read pair once per junction) and the maximum overhang like STAR. "
+             "With --threads each worker scans its own chromosomes."
+    )
 
     # Show help if no args when running from CLI; empty args in notebooks.
     if is_interactive():
         args = parser.parse_args('')
     else:
         args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    maintenance = args.rebuild_motif_cache or args.prune_motif_cache
+    if maintenance and not args.motif_cache:
+        parser.error("--rebuild-motif-cache and --prune-motif-cache need --motif-cache")
+    if not args.inputs and not maintenance:
+        parser.error("at least one --gtf or --bed12 input is required")
+    if args.inputs and not args.out:
+        parser.error("the following arguments are required: -o/--out")
+    args.inputs = args.inputs or []
+    if args.bam and args.support_counts:
+        parser.error("--support-counts cannot be combined with --bam")
+    if args.stream and args.engine == 'columnar':
+        parser.error("--stream cannot be combined with --engine columnar")
     return args
 
 
-def parse_gtf(path):
+def parse_gtf(path, stream=False):
     """
     Yield (chrom, strand, [(exon_start_1b, exon_end_1b), ...]) per transcript.
-    GTF exon coordinates are 1-based inclusive.
+    GTF exon coordinates are 1-based inclusive. With stream=True the GTF must be
+    grouped by transcript or sorted by position (raises UnsortedGTFError otherwise).
     """
-    tx_exons = defaultdict(list)
-    tx_strand = {}
-    with open(path) as fh:
-        for line in fh:
-            if not line or line.startswith('#'):
-                continue
-            parts = line.rstrip('\n').split('\t')
-            if len(parts) < 9:
-                continue
-            chrom, source, feature, start, end, score, strand, frame, attrs = parts
-            if feature != 'exon':
-                continue
-            m = re.search(r'transcript_id\s+"([^"]+)"', attrs) or re.search(r"transcript_id\s+'([^']+)'", attrs)
-            if not m:
-                m2 = re.search(r'gene_id\s+"([^"]+)"', attrs) or re.search(r"gene_id\s+'([^']+)'", attrs)
-                m3 = re.search(r'exon_number\s+"?(\d+)"?', attrs)
-                if m2 and m3:
-                    txid = f"{m2.group(1)}:exonset"
-                else:
-                    continue
-            else:
-                txid = m.group(1)
-            s = int(start)
-            e = int(end)
-            tx_exons[(chrom, txid)].append((s, e))
-            if (chrom, txid) not in tx_strand:
-                tx_strand[(chrom, txid)] = strand
-    for (chrom, txid), exons in tx_exons.items():
-        yield chrom, tx_strand[(chrom, txid)], sorted(exons, key=lambda x: x[0])
+    for tx in gtf_transcripts(path, stream=stream):
+        yield tx.chrom, tx.strand, sorted(tx.exons, key=lambda x: x[0])
 
 
 def parse_bed12(path):
@@ -135,29 +208,11 @@ def parse_bed12(path):
     Yield (chrom, strand, [(exon_start_1b, exon_end_1b), ...]) per BED12 line.
     BED is 0-based, half-open; convert to 1-based inclusive for exons.
     """
-    with open(path) as fh:
-        for line in fh:
-            if not line.strip() or line.startswith('#') or line.startswith('track') or line.startswith('browser'):
-                continue
-            parts = line.rstrip('\n').split('\t')
-            if len(parts) < 12:
-                continue
-            chrom = parts[0]
-            chrom_start = int(parts[1])
-            strand = parts[5] if parts[5] in ('+','-') else '.'
-            block_count = int(parts[9])
-            block_sizes = [int(x) for x in parts[10].rstrip(',').split(',')]
-            block_starts = [int(x) for x in parts[11].rstrip(',').split(',')]
-            if len(block_sizes) != block_count or len(block_starts) != block_count:
-                continue
-            exons = []
-            for bs, bstart in zip(block_sizes, block_starts):
-                exon_start0 = chrom_start + bstart
-                exon_end0   = exon_start0 + bs
-                exon_start1 = exon_start0 + 1
-                exon_end1   = exon_end0
-                exons.append((exon_start1, exon_end1))
-            yield chrom, strand, sorted(exons, key=lambda x: x[0])
+    for rec in read_bed12(path):
+        exons = rec.exons_1b()
+        if exons is None:
+            continue
+        yield rec.chrom, (rec.strand if rec.strand in ('+','-') else '.'), exons
 
 
 def introns_from_exons(exons_1b):
@@ -217,8 +272,822 @@ def fetch_dinucs(ref, chrom, intr_start_1b, intr_end_1b):
     return donor, acceptor, None
 
 
-def write_sj(path_out, rows_iterable):
-    with open(path_out, 'w') as out:
+def lookup_motif(ref, chrom, intr_start_1b, intr_end_1b, cache):
+    """
+    Memoized motif lookup for one intron (1-based inclusive coordinates).
+    Returns (motif_code, reason_if_failed_or_None); motif_code is None on failure.
+    """
+    key = (chrom, intr_start_1b, intr_end_1b)
+    hit = cache.get(key)
+    if hit is None:
+        donor, acceptor, reason = fetch_dinucs(ref, chrom, intr_start_1b, intr_end_1b)
+        hit = (motif_code_from_dinucs(donor, acceptor) if reason is None else None, reason)
+        cache[key] = hit
+    return hit
+
+
+# Lookup tables for the bulk engine: valid bases and packed 4-byte motif keys
+_ACGT = np.zeros(256, dtype=bool)
+_ACGT[np.frombuffer(b'ACGT', dtype=np.uint8)] = True
+_UPPER = np.arange(256, dtype=np.uint8)
+_UPPER[np.frombuffer(b'abcdefghijklmnopqrstuvwxyz', dtype=np.uint8)] -= 32
+# Sequence read per ref.fetch() call in bulk_motifs
+_FETCH_CHUNK = 1 << 24
+_MOTIF_KEYS = [(int.from_bytes(k, 'big'), code) for k, code in
+               ((b'GTAG', 1), (b'CTAC', 2), (b'GCAG', 3), (b'CTGC', 4), (b'ATAC', 5), (b'GTAT', 6))]
+
+
+def bulk_motifs(ref, keys, cache):
+    """
+    Fill the motif cache for many introns at once, one chromosome at a time.
+    Each chromosome is read once, in _FETCH_CHUNK pieces that hold at least
+    one splice site, and all donor/acceptor dinucleotides are gathered from
+    the raw bytes with vectorized indexing; only the gathered bases are
+    uppercased. Introns on unknown chromosomes or
+    reaching past the sequence ends go through fetch_dinucs so their failure
+    reasons are identical to the per-intron path.
+    """
+    by_chrom = defaultdict(list)
+    for key in keys:
+        if key not in cache:
+            by_chrom[key[0]].append(key)
+    chrom_lengths = dict(zip(ref.references, ref.lengths))
+
+    for chrom, chrom_keys in by_chrom.items():
+        chrom_len = chrom_lengths.get(chrom)
+        if chrom_len is None:
+            for key in chrom_keys:
+                lookup_motif(ref, *key, cache)
+            continue
+
+        starts = np.fromiter((k[1] for k in chrom_keys), dtype=np.int64, count=len(chrom_keys))
+        ends   = np.fromiter((k[2] for k in chrom_keys), dtype=np.int64, count=len(chrom_keys))
+        inside = (starts >= 1) & (starts < chrom_len) & (ends >= 2) & (ends <= chrom_len)
+        for i in np.flatnonzero(~inside):
+            lookup_motif(ref, *chrom_keys[i], cache)
+        idx = np.flatnonzero(inside)
+        if not len(idx):
+            continue
+
+        s0 = starts[idx] - 1
+        e0 = ends[idx] - 1
+        positions = np.stack([s0, s0 + 1, e0 - 1, e0], axis=1)
+        bases = np.zeros(positions.shape, dtype=np.uint8)
+        for chunk in np.unique(positions // _FETCH_CHUNK).tolist():
+            lo = chunk * _FETCH_CHUNK
+            seq = ref.fetch(chrom, lo, min(lo + _FETCH_CHUNK, chrom_len))
+            seq = np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)
+            here = (positions >= lo) & (positions < lo + len(seq))
+            bases[here] = seq[positions[here] - lo]
+            del seq
+        bases = _UPPER[bases]
+
+        packed = bases.astype(np.uint32)
+        packed = (packed[:, 0] << 24) | (packed[:, 1] << 16) | (packed[:, 2] << 8) | packed[:, 3]
+        motifs = np.zeros(len(idx), dtype=np.int64)
+        for key, code in _MOTIF_KEYS:
+            motifs[packed == key] = code
+        valid = _ACGT[bases].all(axis=1)
+
+        for i, motif, ok, quad in zip(idx.tolist(), motifs.tolist(), valid.tolist(), bases):
+            if ok:
+                cache[chrom_keys[i]] = (motif, None)
+            else:
+                quad = quad.tobytes().decode('latin-1')
+                cache[chrom_keys[i]] = (None, f"ambiguous_bases:{quad[:2]}/{quad[2:]}")
+
+
+class ChromIds:
+    """
+    Chromosome names interned to small integer ids in first-seen order. One
+    instance is shared by the IntronCollector and the JunctionStore, so
+    junction blocks keep their chrom ids from collection to output.
+    """
+
+    def __init__(self):
+        self.names = []
+        self._ids = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, chrom):
+        cid = self._ids.get(chrom)
+        if cid is None:
+            cid = self._ids[chrom] = len(self.names)
+            self.names.append(chrom)
+        return cid
+
+
+def load_runs(paths, dtype):
+    """Memory-map runs of dtype rows written with ndarray.tofile()."""
+    return [np.memmap(path, dtype=dtype, mode='r') for path in paths]
+
+
+class IntronCollector:
+    """
+    Intron occurrences of all inputs as NumPy columns (chrom id, start, end,
+    strand code, input index), about 23 bytes each. Occurrences are buffered
+    in blocks and compacted (sorted, exact duplicates dropped) as they grow,
+    so memory follows the number of distinct (intron, strand, input)
+    combinations rather than the number of occurrences. With max_items,
+    compacted data beyond half the budget is spilled to tmpdir as a sorted
+    run (see RunFiles) and windows() merges the runs window by window.
+    windows() yields the result per chromosome, split by start position
+    where a chromosome does not fit in max_items.
+    """
+
+    DTYPE = np.dtype([('chrom', np.int32), ('start', np.int64), ('end', np.int64),
+                      ('strand', np.int8), ('input', np.int16)])
+    BLOCK = 1 << 16
+
+    def __init__(self, chroms, max_items=None, tmpdir=None):
+        self.chroms = chroms
+        self.max_items = max_items
+        self.tmpdir = tmpdir
+        # Pending tuples cost more than array rows, so keep them to a fraction of the budget
+        self._block = self.BLOCK if max_items is None else min(self.BLOCK, max(1024, max_items // 4))
+        self._pending = []
+        self._blocks = []
+        self._n_blocked = 0
+        self._compact_at = self._threshold(0)
+        self._runs = RunFiles(self._merge_runs, tmpdir, prefix='annots2sjout.', suffix='.bin')
+
+    def _threshold(self, n):
+        threshold = max(16 * self.BLOCK, 2 * n)
+        return threshold if self.max_items is None else min(threshold, self.max_items)
+
+    def add_transcripts(self, transcripts, index, strand_agnostic=False):
+        """
+        Add the introns of (chrom, strand, sorted exons) transcripts of input
+        index. Returns the number of intron occurrences.
+        """
+        n_total = 0
+        last_chrom = cid = None
+        pending = self._pending
+        for chrom, strand, exons in transcripts:
+            if chrom != last_chrom:
+                cid = self.chroms.intern(chrom)
+                last_chrom = chrom
+            s_code = 0 if strand_agnostic else strand_to_code(strand)
+            for intr_start, intr_end in introns_from_exons(exons):
+                pending.append((cid, intr_start, intr_end, s_code, index))
+            if len(pending) >= self._block:
+                n_total += len(pending)
+                self._flush()
+                pending = self._pending
+        n_total += len(pending)
+        self._flush()
+        return n_total
+
+    def add_table(self, table, index, strand_agnostic=False):
+        """add_transcripts() for the columnar engine's intron table (chrom, strand, start, end)."""
+        codes, names = table['chrom'].factorize()
+        remap = np.array([self.chroms.intern(name) for name in names], dtype=np.int32)
+        block = np.empty(len(table), dtype=self.DTYPE)
+        block['chrom'] = remap[codes]
+        block['start'] = table['start'].to_numpy()
+        block['end'] = table['end'].to_numpy()
+        if strand_agnostic:
+            block['strand'] = 0
+        else:
+            strand = table['strand'].to_numpy()
+            block['strand'] = np.select([strand == '+', strand == '-'], [1, 2], 0)
+        block['input'] = index
+        self._add_block(block)
+        return len(block)
+
+    def _flush(self):
+        if self._pending:
+            self._add_block(np.array(self._pending, dtype=self.DTYPE))
+            self._pending = []
+
+    def _add_block(self, block):
+        self._blocks.append(block)
+        self._n_blocked += len(block)
+        if self._n_blocked >= self._compact_at:
+            self._compact()
+
+    @staticmethod
+    def _unique(data):
+        """data sorted by chrom id, start, end, strand and input, exact duplicates dropped."""
+        data = data[np.lexsort((data['input'], data['strand'], data['end'], data['start'], data['chrom']))]
+        if len(data) > 1:
+            data = data[np.concatenate(([True], data[1:] != data[:-1]))]
+        return data
+
+    def _compact(self):
+        data = self._unique(np.concatenate(self._blocks)) if self._blocks else np.empty(0, dtype=self.DTYPE)
+        if self.max_items is not None and 2 * len(data) > self.max_items:
+            self._spill(data)
+            data = np.empty(0, dtype=self.DTYPE)
+        self._blocks = [data]
+        self._n_blocked = len(data)
+        self._compact_at = self._threshold(len(data))
+        return data
+
+    @property
+    def n_runs(self):
+        return len(self._runs)
+
+    def _spill(self, data):
+        path = self._runs.new_path()
+        data.tofile(path)
+        self._runs.add(path)
+
+    def _merge_runs(self, paths, out_path):
+        with open(out_path, 'wb') as fh:
+            for _, window in self._merged(load_runs(paths, self.DTYPE), largest_first=False):
+                window.tofile(fh)
+
+    def _split(self, pieces):
+        """Split sorted pieces of one chromosome at start positions into windows of about max_items / 2."""
+        step = max(1, self.max_items // (8 * len(pieces)))
+        samples = np.sort(np.concatenate([piece['start'][::step] for piece in pieces]))
+        per_window = max(1, self.max_items // (2 * step))
+        edges = np.unique(samples[per_window::per_window])
+        cuts = [np.concatenate(([0], np.searchsorted(piece['start'], edges), [len(piece)])) for piece in pieces]
+        for w in range(len(edges) + 1):
+            yield [piece[cut[w]:cut[w + 1]] for piece, cut in zip(pieces, cuts)]
+
+    def _merged(self, sources, largest_first=True):
+        """Merge sorted, unique sources into (chrom id, array) windows."""
+        n_chroms = len(self.chroms)
+        offsets = [np.concatenate(([0], np.cumsum(np.bincount(src['chrom'], minlength=n_chroms))))
+                   for src in sources]
+        sizes = np.sum([np.diff(off) for off in offsets], axis=0) if n_chroms else np.empty(0, dtype=np.int64)
+        order = np.argsort(-sizes, kind='stable') if largest_first else range(n_chroms)
+        for cid in order:
+            n = int(sizes[cid])
+            if not n:
+                continue
+            pieces = [src[off[cid]:off[cid + 1]] for src, off in zip(sources, offsets)]
+            pieces = [piece for piece in pieces if len(piece)]
+            windows = [pieces] if self.max_items is None or n <= self.max_items else self._split(pieces)
+            for window in windows:
+                window = [piece for piece in window if len(piece)]
+                if len(window) == 1:
+                    yield int(cid), np.asarray(window[0])
+                elif window:
+                    yield int(cid), self._unique(np.concatenate(window))
+
+    def windows(self):
+        """
+        Yield (chrom id, array) per chromosome, largest first; arrays are
+        sorted and unique. With max_items, a chromosome larger than that is
+        yielded in several windows of whole start positions.
+        """
+        self._flush()
+        data = self._compact()
+        yield from self._merged(load_runs(self._runs.paths, self.DTYPE) + [data])
+
+    def clear(self):
+        """Drop all collected introns and spilled runs."""
+        self._pending = []
+        self._blocks = []
+        self._n_blocked = 0
+        self._compact_at = self._threshold(0)
+        self._runs.clear()
+
+    close = clear
+
+
+class MotifCache(dict):
+    """
+    Motif cache ({(chrom, start, end): (motif, reason)}, as used by
+    lookup_motif()) backed by an SQLite file. preload() pulls the stored
+    entries for the given introns of this reference digest (one start range
+    per chromosome); flush() writes back everything added since.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS motifs (digest TEXT, chrom TEXT, start INTEGER, end INTEGER, "
+        "motif INTEGER, reason TEXT, PRIMARY KEY (digest, chrom, start, end)) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS refs (path TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, "
+        "PRIMARY KEY (path, size, mtime_ns))",
+    )
+
+    def __init__(self, db_path, digest):
+        super().__init__()
+        self.digest = digest
+        self.db = open_motif_db(db_path)
+        self._stored = set()
+        self.n_loaded = 0
+        self.n_stored = 0
+
+    def preload(self, keys):
+        by_chrom = defaultdict(set)
+        for key in keys:
+            if key not in self:
+                by_chrom[key[0]].add(key[1:])
+        for chrom, wanted in by_chrom.items():
+            starts = [start for start, _ in wanted]
+            rows = self.db.execute("SELECT start, end, motif, reason FROM motifs "
+                                   "WHERE digest = ? AND chrom = ? AND start BETWEEN ? AND ?",
+                                   (self.digest, chrom, min(starts), max(starts)))
+            for start, end, motif, reason in rows:
+                if (start, end) in wanted:
+                    key = (chrom, start, end)
+                    self[key] = (motif, reason)
+                    self._stored.add(key)
+                    self.n_loaded += 1
+
+    def flush(self):
+        new = [key for key in self if key not in self._stored]
+        if not new:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO motifs VALUES (?, ?, ?, ?, ?, ?)",
+                ((self.digest, *key, *self[key]) for key in new))
+        self._stored.update(new)
+        self.n_stored += len(new)
+
+    def clear(self):
+        """Drop the in-memory entries (after flush(); the file keeps them)."""
+        super().clear()
+        self._stored.clear()
+
+
+def open_motif_db(db_path):
+    db = sqlite3.connect(db_path, timeout=600)
+    for statement in MotifCache.SCHEMA:
+        db.execute(statement)
+    db.commit()
+    return db
+
+
+def reference_digest(db_path, ref_path):
+    """
+    SHA-256 of the reference FASTA file. The digest is remembered in the cache
+    per (path, size, mtime) so an unchanged FASTA is only hashed once.
+    """
+    stat = os.stat(ref_path)
+    path = str(Path(ref_path).resolve())
+    db = open_motif_db(db_path)
+    try:
+        hit = db.execute("SELECT digest FROM refs WHERE path = ? AND size = ? AND mtime_ns = ?",
+                         (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if hit:
+            return hit[0]
+        logging.info(f"Computing reference checksum for the motif cache: {ref_path}")
+        sha = hashlib.sha256()
+        with open(ref_path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        with db:
+            db.execute("DELETE FROM refs WHERE path = ?", (path,))
+            db.execute("INSERT INTO refs VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+    finally:
+        db.close()
+
+
+def maintain_motif_cache(db_path, digest, rebuild=False, prune=False):
+    """--rebuild-motif-cache / --prune-motif-cache. Returns the number of entries removed."""
+    db = open_motif_db(db_path)
+    try:
+        removed = 0
+        with db:
+            if rebuild:
+                removed += db.execute("DELETE FROM motifs WHERE digest = ?", (digest,)).rowcount
+            if prune:
+                removed += db.execute("DELETE FROM motifs WHERE digest != ?", (digest,)).rowcount
+                db.execute("DELETE FROM refs WHERE digest != ?", (digest,))
+        if prune:
+            db.execute("VACUUM")
+        return removed
+    finally:
+        db.close()
+
+
+def new_motif_cache(motif_db):
+    """Per-process motif cache: persistent for motif_db = (db_path, digest), else a plain dict."""
+    return MotifCache(*motif_db) if motif_db else {}
+
+
+def open_bams(paths):
+    return [pysam.AlignmentFile(path, 'rb') for path in paths]
+
+
+def count_junction_reads(bams, chrom, junctions, start=None, end=None):
+    """
+    Tally the spliced alignments on chrom (0-based start..end when given;
+    it must cover the junctions) over junctions ({(start, end)}, 1-based
+    inclusive) in all BAM handles, counted like STAR: NH==1 primary
+    alignments as unique, every alignment with NH>1 as multi-mapping, a read
+    pair once per junction even where both mates cross it, and the overhang
+    as the shorter of the two aligned blocks next to the junction, blocks
+    being split at insertions and deletions as well.
+    Returns {(start, end): [unique, multi, max_overhang]} for junctions with reads.
+    """
+    counts = {}
+    for bam in bams:
+        if bam.get_tid(chrom) < 0:
+            continue
+        # (query name, junction) of mates counted before the other mate is fetched
+        seen = set()
+        for read in bam.fetch(chrom, start, end):
+            if read.is_unmapped or read.is_supplementary or read.is_qcfail:
+                continue
+            cigar = read.cigartuples
+            if not any(op == 3 for op, _ in cigar):
+                continue
+            nh = read.get_tag('NH') if read.has_tag('NH') else 1
+            if nh == 1 and read.is_secondary:
+                continue
+            paired = (read.is_paired and not read.mate_is_unmapped
+                      and read.next_reference_id == read.reference_id)
+
+            # Aligned bases per block between N, D and I operations
+            pos = read.reference_start
+            keys = []
+            blocks = [0]
+            for op, length in cigar:
+                if op in (0, 7, 8):        # M, =, X
+                    blocks[-1] += length
+                    pos += length
+                elif op == 1:              # I
+                    blocks.append(0)
+                elif op == 2:              # D
+                    blocks.append(0)
+                    pos += length
+                elif op == 3:              # N
+                    keys.append(((pos + 1, pos + length), len(blocks) - 1))
+                    blocks.append(0)
+                    pos += length
+
+            for key, i in keys:
+                if key not in junctions:
+                    continue
+                tally = counts.get(key)
+                if tally is None:
+                    tally = counts[key] = [0, 0, 0]
+                tally[2] = max(tally[2], min(blocks[i], blocks[i + 1]))
+                if paired:
+                    token = (read.query_name, key)
+                    if token in seen:
+                        seen.discard(token)
+                        continue
+                    if read.reference_start <= read.next_reference_start < key[1]:
+                        seen.add(token)
+                tally[0 if nh == 1 else 1] += 1
+    return counts
+
+
+# Unique introns per motif lookup batch in annotate_introns()
+_LOOKUP_BATCH = 1 << 16
+
+
+def annotate_introns(ref, chrom, cid, data, n_inputs, args, cache, bams=()):
+    """
+    Annotate the introns of one chromosome: data is the IntronCollector
+    array of chrom (id cid), sorted and unique. Support counts and the
+    per-input totals come from array operations; intron lengths are
+    filtered, motifs looked up once per unique (start, end) in batches of
+    _LOOKUP_BATCH (cache is emptied after each, once flushed), and the kept
+    junctions returned as a JunctionStore block. With bams, columns 7-9 come
+    from count_junction_reads() over each batch's region.
+    Returns (block, failures as (chrom, start, end, reason), stats Counter, motif Counter).
+    """
+    failures = []
+    stats = Counter()
+    motif_counts = Counter()
+
+    start = data['start']
+    end = data['end']
+    new_key = np.ones(len(data), dtype=bool)
+    new_key[1:] = (start[1:] != start[:-1]) | (end[1:] != end[:-1])
+    key_id = np.cumsum(new_key) - 1
+    first = np.flatnonzero(new_key)
+    key_start = start[first]
+    key_end = end[first]
+    n_keys = len(first)
+    stats['introns_unique'] += n_keys
+
+    # Inputs per intron: totals per input and introns found in one input only
+    pairs = np.unique(key_id * n_inputs + data['input'])
+    pair_key, pair_input = np.divmod(pairs, n_inputs)
+    inputs_per_key = np.bincount(pair_key, minlength=n_keys)
+    unique_per_input = np.bincount(pair_input, minlength=n_inputs)
+    private_per_input = np.bincount(pair_input[inputs_per_key[pair_key] == 1], minlength=n_inputs)
+    for index in range(n_inputs):
+        stats[('input', index, 'introns_unique')] += int(unique_per_input[index])
+        stats[('input', index, 'private')] += int(private_per_input[index])
+
+    # Support: number of inputs per (intron, strand)
+    groups, support = np.unique(key_id * 3 + data['strand'], return_counts=True)
+    group_key, group_strand = np.divmod(groups, 3)
+
+    length = key_end - key_start + 1
+    in_range = (length >= args.min_intron) & (length <= args.max_intron)
+    stats['skipped_by_length'] += int(n_keys - in_range.sum())
+    kept_keys = np.flatnonzero(in_range)
+
+    # Motif per intron; -1 for introns that are not written. Looked up in
+    # batches so the motif memo and read tallies only ever hold one batch
+    motifs = np.full(n_keys, -1, dtype=np.int8)
+    if bams:
+        reads = np.zeros((n_keys, 3), dtype=np.int64)
+    persistent = isinstance(cache, MotifCache)
+    for lo in range(0, len(kept_keys), _LOOKUP_BATCH):
+        batch = kept_keys[lo:lo + _LOOKUP_BATCH]
+        wanted = [(chrom, s, e) for s, e in zip(key_start[batch].tolist(), key_end[batch].tolist())]
+        if persistent:
+            loaded = cache.n_loaded
+            cache.preload(wanted)
+            stats['motif_cache_hits'] += cache.n_loaded - loaded
+        if args.bulk_fetch:
+            bulk_motifs(ref, wanted, cache)
+
+        for k, (_, intr_start, intr_end) in zip(batch.tolist(), wanted):
+            motif_val, reason = lookup_motif(ref, chrom, intr_start, intr_end, cache)
+            if reason is not None:
+                stats['failed'] += 1
+                failures.append((chrom, intr_start, intr_end, reason))
+                if args.on_missing == 'skip':
+                    stats['skipped_by_missing'] += 1
+                    continue
+                motif_val = 0  # user explicitly chose to emit non-canonical (0) on missing
+            motifs[k] = motif_val
+
+        if bams:
+            written = batch[motifs[batch] >= 0]
+            index_of = dict(zip(zip(key_start[written].tolist(), key_end[written].tolist()), written.tolist()))
+            region = (int(key_start[batch].min()) - 1, int(key_end[batch].max()))
+            for key, tally in count_junction_reads(bams, chrom, index_of, *region).items():
+                reads[index_of[key]] = tally
+            stats['with_reads'] += int(np.count_nonzero(reads[written, 0] + reads[written, 1]))
+            del index_of
+
+        if persistent:
+            stored = cache.n_stored
+            cache.flush()
+            stats['motif_cache_new'] += cache.n_stored - stored
+        cache.clear()
+
+    emit = motifs[group_key] >= 0
+    rows_key = group_key[emit]
+    block = np.zeros(len(rows_key), dtype=JunctionStore.DTYPE)
+    block['chrom'] = cid
+    block['start'] = key_start[rows_key]
+    block['end'] = key_end[rows_key]
+    block['strand'] = group_strand[emit]
+    block['motif'] = motifs[rows_key]
+    # Columns 7-9: spanning reads and overhang from the BAMs, else
+    # --support-counts / --uniq-reads with 0, 0
+    if bams:
+        block['uniq'] = reads[rows_key, 0]
+        block['multi'] = reads[rows_key, 1]
+        block['overhang'] = reads[rows_key, 2]
+    else:
+        block['uniq'] = support[emit] if args.support_counts else args.uniq_reads
+
+    stats['kept'] += len(block)
+    motif_counts.update(dict(zip(*(a.tolist() for a in np.unique(block['motif'], return_counts=True)))))
+    return block, failures, stats, motif_counts
+
+
+def collect_inputs(collector, parts, args):
+    """
+    Add every input in parts ((index, kind, payload), kind 'transcripts' or
+    'table') to collector. Returns a stats Counter with the intron totals,
+    overall and per input under ('input', index, 'introns_total').
+    """
+    stats = Counter()
+    for index, kind, payload in parts:
+        if kind == 'table':
+            n_total = collector.add_table(payload, index, args.strand_agnostic)
+        else:
+            n_total = collector.add_transcripts(payload, index, args.strand_agnostic)
+        stats['introns_total'] += n_total
+        stats[('input', index, 'introns_total')] += n_total
+    return stats
+
+
+# Per-process state for --threads workers
+_WORKER = {}
+
+
+def init_worker(ref_path, args, motif_db):
+    _WORKER['ref'] = pysam.FastaFile(ref_path)
+    _WORKER['args'] = args
+    _WORKER['cache'] = new_motif_cache(motif_db)
+    _WORKER['bams'] = open_bams(args.bam)
+
+
+def process_window(task):
+    """Pool task: annotate_introns() for one (chrom, cid, data, n_inputs) window."""
+    chrom, cid, data, n_inputs = task
+    return annotate_introns(_WORKER['ref'], chrom, cid, data, n_inputs, _WORKER['args'],
+                            _WORKER['cache'], _WORKER['bams'])
+
+
+def annotate(ref, ref_path, collector, args, motif_db=None):
+    """
+    Annotate the collected introns window by window (see
+    IntronCollector.windows()), serially or on args.threads workers. Yields
+    one annotate_introns() result per window; at most 2 * args.threads
+    windows are in flight at a time. motif_db: (db_path, digest) of a
+    persistent motif cache, or None.
+    """
+    names = collector.chroms.names
+    n_inputs = len(args.inputs)
+    if args.threads <= 1:
+        logging.info("Computing junction motifs...")
+        cache = new_motif_cache(motif_db)
+        bams = open_bams(args.bam)
+        for cid, data in collector.windows():
+            yield annotate_introns(ref, names[cid], cid, data, n_inputs, args, cache, bams)
+        for bam in bams:
+            bam.close()
+        return
+    logging.info(f"Computing junction motifs for {len(names)} chromosomes with {args.threads} workers...")
+    # imap would drain windows() up front; submitting a bounded number keeps
+    # merged windows from piling up in memory
+    pending = deque()
+    with multiprocessing.Pool(args.threads, initializer=init_worker,
+                              initargs=(ref_path, args, motif_db)) as pool:
+        for cid, data in collector.windows():
+            if len(pending) >= 2 * args.threads:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(process_window, ((names[cid], cid, data, n_inputs),)))
+        while pending:
+            yield pending.popleft().get()
+
+
+def merge_results(results, sj_rows, failures):
+    """
+    Collect annotate_introns() results into the sj_rows store and the
+    failures sorter. Returns (stats Counter, motif Counter).
+    """
+    stats = Counter()
+    motif_counts = Counter()
+    for block, fails, part_stats, part_motifs in results:
+        sj_rows.add_block(block)
+        failures.extend(fails)
+        stats.update(part_stats)
+        motif_counts.update(part_motifs)
+    return stats, motif_counts
+
+
+def input_parts(args, stream):
+    """Yield (index, kind, payload) per input, reading each one when it is reached."""
+    for index, (fmt, path) in enumerate(args.inputs):
+        logging.info(f"Reading {fmt.upper()} input {index + 1}/{len(args.inputs)}: {path}")
+        if fmt == 'bed12':
+            yield index, 'transcripts', parse_bed12(path)
+        elif args.engine == 'columnar':
+            from omics_toolkit.columnar import gtf_intron_table
+            yield index, 'table', gtf_intron_table(path)
+        else:
+            problem = stream and gtf_stream_problem(path)
+            if problem:
+                logging.warning(f"Not streaming {path}: {problem}; reading it in memory")
+            yield index, 'transcripts', parse_gtf(path, stream=stream and not problem)
+
+
+# Rough in-memory footprint of a buffered failure / stored junction / collected
+# intron (including sort temporaries), for --max-memory
+_ROW_BYTES = 250
+_JUNCTION_BYTES = 90
+_INTRON_BYTES = 80
+
+
+class JunctionStore:
+    """
+    Compact columnar store of kept junctions. Chromosomes are ChromIds ids
+    shared with the IntronCollector and rows are held in blocks of a
+    structured NumPy array (chrom id, start, end, strand, motif, columns 7-9),
+    about 40 bytes per junction. Iterating yields complete SJ.out.tab rows
+    sorted by chrom, start, end and strand with exact duplicates dropped; the
+    constant column 6 is only added there. With max_items, sorted runs are
+    spilled to tmpdir as RunFiles, which merges them in levels to bound open
+    files, and merged on iteration.
+    """
+
+    DTYPE = np.dtype([('chrom', np.int32), ('start', np.int64), ('end', np.int64),
+                      ('strand', np.int8), ('motif', np.int8), ('uniq', np.int32),
+                      ('multi', np.int32), ('overhang', np.int32)])
+    BLOCK = 1 << 16
+
+    def __init__(self, chroms, max_items=None, tmpdir=None):
+        self.chroms = chroms
+        self.max_items = max_items
+        self.tmpdir = tmpdir
+        self._blocks = []
+        self._n_blocked = 0
+        self._runs = RunFiles(self._merge_runs, tmpdir, prefix='annots2sjout.', suffix='.bin')
+
+    @property
+    def names(self):
+        return self.chroms.names
+
+    def add_block(self, block):
+        """Add a DTYPE array of junctions with chrom ids of self.chroms."""
+        self._blocks.append(block)
+        self._n_blocked += len(block)
+        if self.max_items is not None and self._n_blocked >= self.max_items:
+            self._spill()
+
+    @property
+    def n_runs(self):
+        return len(self._runs)
+
+    def _rank(self):
+        """Output rank of each chrom id (chromosomes sort by name)."""
+        rank = np.empty(len(self.names), dtype=np.int32)
+        rank[sorted(range(len(self.names)), key=self.names.__getitem__)] = np.arange(len(self.names))
+        return rank
+
+    def _sorted(self):
+        """Buffered junctions as one array, sorted and de-duplicated."""
+        if not self._blocks:
+            return np.empty(0, dtype=self.DTYPE)
+        data = np.concatenate(self._blocks)
+        self._blocks = []
+        self._n_blocked = 0
+        rank = self._rank()
+        data = data[np.lexsort((data['strand'], data['end'], data['start'], rank[data['chrom']]))]
+        if len(data) > 1:
+            data = data[np.concatenate(([True], data[1:] != data[:-1]))]
+        return data
+
+    def _spill(self):
+        path = self._runs.new_path()
+        self._sorted().tofile(path)
+        self._runs.add(path)
+
+    def _merge_runs(self, paths, out_path):
+        size = max(256, self.max_items // 4)
+        with open(out_path, 'wb') as fh:
+            rows = []
+            for row in self._merged(load_runs(paths, self.DTYPE)):
+                rows.append(row)
+                if len(rows) >= size:
+                    np.array(rows, dtype=self.DTYPE).tofile(fh)
+                    rows = []
+            np.array(rows, dtype=self.DTYPE).tofile(fh)
+
+    @staticmethod
+    def _records(data, size):
+        for i in range(0, len(data), size):
+            yield from data[i:i + size].tolist()
+
+    def _merged(self, sources):
+        """Unique (chrom id, start, end, strand, motif, uniq, multi, overhang) tuples of sorted sources, in order."""
+        # Sorting is stable and heapq.merge prefers earlier runs on ties
+        if len(sources) == 1:
+            rows = self._records(sources[0], self.BLOCK)
+        else:
+            # Rows being merged are Python tuples, several times their array size
+            size = max(256, self.max_items // (4 * len(sources)))
+            rank = self._rank().tolist()
+            rows = heapq.merge(*(self._records(src, size) for src in sources),
+                               key=lambda r: (rank[r[0]], r[1], r[2], r[3]))
+        previous = None
+        for row in rows:
+            if row != previous:
+                yield row
+            previous = row
+
+    def __iter__(self):
+        # STAR SJ.out.tab columns:
+        # 1:chrom 2:start 3:end 4:strand(0/1/2) 5:motif 6:annotated 7:uniq 8:multi 9:max_overhang
+        names = self.names
+        data = self._sorted()
+        for cid, start, end, strand, motif, uniq, multi, overhang in self._merged(load_runs(self._runs.paths, self.DTYPE) + [data]):
+            yield names[cid], start, end, strand, motif, 1, uniq, multi, overhang
+
+    def clear(self):
+        """Drop all junctions and spilled runs."""
+        self._blocks = []
+        self._n_blocked = 0
+        self._runs.clear()
+
+    close = clear
+
+
+def intron_collector(args, chroms):
+    """IntronCollector (with chroms ids) holding half of --max-memory."""
+    max_introns = max(1, args.max_memory // (2 * _INTRON_BYTES)) if args.max_memory else None
+    return IntronCollector(chroms, max_introns, tmpdir=args.tmp_dir)
+
+
+def output_sorters(args, chroms):
+    """Junction store (with chroms ids) and failure sorter, a quarter of --max-memory each."""
+    max_junctions = max_failures = None
+    if args.max_memory:
+        max_junctions = max(1, args.max_memory // (4 * _JUNCTION_BYTES))
+        max_failures = max(1, args.max_memory // (4 * _ROW_BYTES))
+    sj_rows = JunctionStore(chroms, max_junctions, tmpdir=args.tmp_dir)
+    failures = ExternalSorter(max_failures, tmpdir=args.tmp_dir)
+    return sj_rows, failures
+
+
+def write_sj(path_out, rows_iterable, threads=1):
+    with open_output(path_out, threads) as out:
         for row in rows_iterable:
             out.write('\t'.join(map(str, row)) + '\n')
 
@@ -231,10 +1100,21 @@ def main():
     args = parse_args()
 
     # Input existence checks
-    in_path = Path(args.gtf) if args.gtf else Path(args.bed12)
-    if not in_path.is_file():
-        logging.error(f"File not found: {in_path}")
-        sys.exit(1)
+    for fmt, path in args.inputs:
+        if not Path(path).is_file():
+            logging.error(f"File not found: {path}")
+            sys.exit(1)
+
+    for bam_path in args.bam:
+        try:
+            with pysam.AlignmentFile(bam_path, 'rb') as bam:
+                indexed = bam.has_index()
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to open BAM via pysam: {e}")
+            sys.exit(1)
+        if not indexed:
+            logging.error(f"BAM index not found (run samtools index): {bam_path}")
+            sys.exit(1)
 
     ref_path = Path(args.ref_fasta)
     if not ref_path.is_file():
@@ -244,6 +1124,18 @@ def main():
     if not fai_path.is_file():
         logging.info("FASTA index (.fai) not found; pysam/htslib will attempt to create it if permissions allow.")
 
+    # Persistent motif cache
+    motif_db = None
+    if args.motif_cache:
+        digest = reference_digest(args.motif_cache, str(ref_path))
+        motif_db = (args.motif_cache, digest)
+        if args.rebuild_motif_cache or args.prune_motif_cache:
+            removed = maintain_motif_cache(args.motif_cache, digest, args.rebuild_motif_cache, args.prune_motif_cache)
+            logging.info(f"Removed {removed} entries from motif cache {args.motif_cache}")
+    if not args.inputs:
+        # Cache maintenance only
+        return
+
     # Open FASTA
     logging.info(f"Opening reference FASTA: {ref_path}")
     try:
@@ -252,67 +1144,64 @@ def main():
         logging.error(f"Failed to open FASTA via pysam: {e}")
         sys.exit(1)
 
-    # Iterator over transcripts
-    iterator = parse_gtf(str(in_path)) if args.gtf else parse_bed12(str(in_path))
-
     # Failures file
     fail_path = args.fail if args.fail else (args.out + '.failures.tsv')
     try:
-        fail_fh = open(fail_path, 'w')
+        fail_fh = open_output(fail_path, args.threads)
     except Exception as e:
         logging.error(f"Could not open failures file for writing: {e}")
         sys.exit(1)
     fail_fh.write('chrom\tstart\tend\treason\n')
 
-    sj_set = set()
-    n_total_introns = 0
-    n_kept = 0
-    n_failed = 0
-    n_skipped_by_len = 0
-    n_skipped_missing = 0
-    motif_counts = Counter()
-
-    logging.info("Scanning transcripts and computing junction motifs...")
-    for chrom, strand, exons in iterator:
-        introns = introns_from_exons(exons)
-        s_code = 0 if args.strand_agnostic else strand_to_code(strand)
-        for intr_start, intr_end in introns:
-            n_total_introns += 1
-            length = intr_end - intr_start + 1
-            if length < args.min_intron or length > args.max_intron:
-                n_skipped_by_len += 1
-                continue
-
-            donor, acceptor, reason = fetch_dinucs(ref, chrom, intr_start, intr_end)
-            if reason is None:
-                motif_val = motif_code_from_dinucs(donor, acceptor)
-            else:
-                n_failed += 1
-                fail_fh.write(f"{chrom}\t{intr_start}\t{intr_end}\t{reason}\n")
-                if args.on_missing == 'skip':
-                    n_skipped_missing += 1
-                    continue
-                motif_val = 0  # user explicitly chose to emit non-canonical (0) on missing
+    # Deduplicate introns first; filtering, motif lookups and failure logging
+    # then run once per unique (chrom, start, end)
+    # (merged across all inputs)
+    logging.info("Scanning transcripts and collecting unique introns...")
+    chroms = ChromIds()
+    collector = intron_collector(args, chroms)
+    try:
+        stats = collect_inputs(collector, input_parts(args, args.stream), args)
+    except UnsortedGTFError as e:
+        logging.warning(f"GTF is not grouped or sorted ({e}); falling back to in-memory parsing")
+        collector.clear()
+        stats = collect_inputs(collector, input_parts(args, False), args)
 
-            # STAR SJ.out.tab columns:
-            # 1:chrom 2:start 3:end 4:strand(0/1/2) 5:motif 6:annotated 7:uniq 8:multi 9:max_overhang
-            row = (
-                chrom, intr_start, intr_end,
-                s_code, motif_val,
-                1,                # annotated (present in annotation)
-                args.uniq_reads,  # unique spanning reads
-                0,                # multi-mapping spanning reads
-                0                 # max overhang
+    # Rows and failures are unique per key, so sorting makes the output
+    # independent of partitioning and worker scheduling
+    sj_rows, failures = output_sorters(args, chroms)
+    if collector.n_runs:
+        logging.info(f"Merging {collector.n_runs} intron runs spilled to disk")
+    annotated, motif_counts = merge_results(
+        annotate(ref, str(ref_path), collector, args, motif_db), sj_rows, failures)
+    stats.update(annotated)
+    collector.close()
+    logging.info(f"Collected {stats['introns_unique']} unique introns from {stats['introns_total']} intron occurrences")
+    if len(args.inputs) > 1:
+        for index, (fmt, path) in enumerate(args.inputs):
+            logging.info(
+                f"Input {index + 1} ({path}): introns_total={stats[('input', index, 'introns_total')]} "
+                f"introns_unique={stats[('input', index, 'introns_unique')]} "
+                f"private={stats[('input', index, 'private')]}"
             )
-            sj_set.add(row)
-            n_kept += 1
-            motif_counts[motif_val] += 1
+
+    if args.bam:
+        logging.info(f"Junction reads counted from {len(args.bam)} BAM(s): "
+                     f"{stats['with_reads']} annotated junctions have spliced reads")
+    if motif_db:
+        logging.info(f"Motif cache: {stats['motif_cache_hits']} junctions reused, "
+                     f"{stats['motif_cache_new']} added to {args.motif_cache}")
 
     # Write output
+    if sj_rows.n_runs or failures.n_runs:
+        logging.info(f"Merging {sj_rows.n_runs} junction and {failures.n_runs} failure runs spilled to disk")
     logging.info(f"Writing SJ.out.tab to: {args.out}")
-    write_sj(args.out, sorted(sj_set, key=lambda r: (r[0], r[1], r[2], r[3])))
+    write_sj(args.out, sj_rows, args.threads)
+    sj_rows.close()
 
+    for chrom, intr_start, intr_end, reason in failures:
+        fail_fh.write(f"{chrom}\t{intr_start}\t{intr_end}\t{reason}\n")
     fail_fh.close()
+    failures.close()
     logging.info(f"Failures logged to: {fail_path}")
 
     # Motif summary
@@ -323,9 +1212,9 @@ def main():
     logging.info(f"Canonical total (1–6): {canonical_total}; Non-canonical (0): {noncanonical_total}")
 
     logging.info(
-        f"Done. introns_total={n_total_introns} kept={n_kept} "
-        f"skipped_by_length={n_skipped_by_len} lookup_failures_logged={n_failed} "
-        f"skipped_by_missing={n_skipped_missing}"
+        f"Done. introns_total={stats['introns_total']} introns_unique={stats['introns_unique']} "
+        f"kept={stats['kept']} skipped_by_length={stats['skipped_by_length']} "
+        f"lookup_failures_logged={stats['failed']} skipped_by_missing={stats['skipped_by_missing']}"
     )
 
 
@@ -1,33 +1,1108 @@
-#! /usr/bin/env python
+#!/usr/bin/env python3
+
+# Strand-aware coverage extraction from a pair of positive/negative strand bigwig
+# files. Runs as a command line tool, or import it for in-process use:
+#
+#    from bigWigCoverage import BigWigCoverage, read_regions
+#    with BigWigCoverage('sample.pos.bw', 'sample.neg.bw') as cov:
+#       for region, values in cov.query(read_regions('tss.bed')):
+#          ...
 
 # IMPORT
 import sys
 import os
 import pyBigWig as py
 import csv
-import pandas as pd
+import struct
+import shutil
+import tempfile
+import zipfile
+import gzip
+import io
+import warnings
+import multiprocessing
+import hashlib
+import queue
+import threading
+import signal
+import fcntl
+from collections import deque, OrderedDict
 import numpy as np
 
 #############
 # FUNCTIONS #
 #############
 
+## Position labels are shared across regions; grown on demand
+_POS_LABELS = np.empty(0, dtype=object)
+
+def position_labels(n):
+   global _POS_LABELS
+   if n > len(_POS_LABELS):
+      _POS_LABELS = np.arange(max(n, 2 * len(_POS_LABELS))).astype(str).astype(object)
+   return _POS_LABELS[:n]
+
+
+## Format one region as a block of "name<TAB>offset<TAB>value" lines. Offsets default
+## to 0..n-1; with ends given, lines are "name<TAB>start<TAB>end<TAB>value" runs
+def format_block(name, values, offsets=None, ends=None):
+   n = len(values)
+   if n == 0:
+      return ''
+   # Each distinct value is formatted once; the suffix carries the next line's name
+   uniq, inv = np.unique(values, return_inverse=True)
+   suffix    = np.array(['\t%r\n%s\t' % (v, name) for v in uniq.tolist()], dtype=object)
+   tokens    = np.empty((n, 2), dtype=object)
+   if offsets is None:
+      tokens[:, 0] = position_labels(n)
+   else:
+      labels = position_labels(int(max(offsets[-1], ends[-1] if ends is not None else 0)) + 1)
+      tokens[:, 0] = labels[offsets]
+      if ends is not None:
+         tokens[:, 0] += '\t' + labels[ends]
+   tokens[:, 1] = suffix[inv.ravel()]
+   block = name + '\t' + ''.join(tokens.ravel().tolist())
+   return block[:-(len(name) + 1)]
+
+
+## Strand of regions that do not give one (bed3/bed4 lines, 3- or 4-tuples):
+## values come from the positive strand bigwig, in genome order
+DEFAULT_STRAND = '+'
+
+
+## Open a plain or gzip/bgzip compressed text file, or stdin for '-'
+def open_text(path):
+   if path == '-':
+      raw = getattr(sys.stdin, 'buffer', sys.stdin)
+   else:
+      raw = open(path, 'rb')
+   stream = io.BufferedReader(raw) if not hasattr(raw, 'peek') else raw
+   if stream.peek(2)[:2] == b'\x1f\x8b':
+      stream = gzip.GzipFile(fileobj=stream)
+   return io.TextIOWrapper(stream)
+
+
+## Stream (chrom, start, end, name, strand) tuples from a bed6 file. Shorter bed
+## lines get name '.' and strand DEFAULT_STRAND, like as_region()
+def read_regions(path):
+   fh = open_text(path)
+   try:
+      for line in fh:
+         if not line.strip() or line.startswith(('#', 'track', 'browser')):
+            continue
+         fields = line.rstrip('\r\n').split('\t')
+         if len(fields) < 3:
+            raise ValueError('invalid bed line: %s' % line.rstrip())
+         yield (fields[0], int(fields[1]), int(fields[2]),
+                fields[3] if len(fields) > 3 else '.',
+                fields[5] if len(fields) > 5 else DEFAULT_STRAND)
+   finally:
+      fh.close()
+
+
+## Longest region in a bed file (used to size padded matrices)
+def max_region_length(path):
+   return max((region[2] - region[1] for region in read_regions(path)), default=0)
+
+
+## Strand-aware coverage for one (chrom, start, end, name, strand) region
+def fetch_values(bw_pos, bw_neg, region):
+   if region[4] == "+":
+      range_data = bw_pos.values(region[0], region[1], region[2])
+   else:
+      range_data = bw_neg.values(region[0], region[1], region[2])[::-1]
+   return np.nan_to_num(range_data)
+
+
+## Strand-aware covered runs of a region from the bigwig intervals, as
+## (start, end, value) arrays of half-open offsets into the region
+def fetch_runs(bw_pos, bw_neg, region):
+   chrom, start, end = region[0], region[1], region[2]
+   if region[4] == "+":
+      runs = bw_pos.intervals(chrom, start, end)
+   else:
+      runs = bw_neg.intervals(chrom, start, end)
+   if not runs:
+      return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+   runs   = np.array(runs, dtype=np.float64)
+   starts = np.maximum(runs[:, 0].astype(np.int64), start) - start
+   ends   = np.minimum(runs[:, 1].astype(np.int64), end) - start
+   if region[4] != "+":
+      starts, ends = (end - start) - ends[::-1], (end - start) - starts[::-1]
+      return starts, ends, np.nan_to_num(runs[::-1, 2])
+   return starts, ends, np.nan_to_num(runs[:, 2])
+
+
+## Expand runs to per-position (offset, value) arrays
+def expand_runs(starts, ends, values):
+   lengths = ends - starts
+   offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+   return offsets, np.repeat(values, lengths)
+
+
+## Dense strand-aware coverage built only from the covered runs
+def fetch_sparse_values(bw_pos, bw_neg, region):
+   range_data = np.zeros(region[2] - region[1])
+   offsets, values = expand_runs(*fetch_runs(bw_pos, bw_neg, region))
+   range_data[offsets] = values
+   return range_data
+
+
+## Dense values for a chunk of regions. Regions on the same chrom and strand that
+## overlap or lie within gap bp of each other are fetched as one span, and each
+## region is sliced back out of it; results are returned in chunk order
+def fetch_coalesced(bw_pos, bw_neg, chunk, gap, sparse=False):
+   fetch  = fetch_sparse_values if sparse else fetch_values
+   result = [None] * len(chunk)
+   order  = sorted(range(len(chunk)), key=lambda i: (chunk[i][0], chunk[i][4] == "+", chunk[i][1]))
+   group  = []
+   span_end = None
+   for i in order + [None]:
+      region = chunk[i] if i is not None else None
+      if group:
+         first = chunk[group[0]]
+         if region is None or region[0] != first[0] or (region[4] == "+") != (first[4] == "+") or region[1] > span_end + gap:
+            # Minus-strand spans come back reversed, so slices are taken from the span end
+            lo   = first[1]
+            span = fetch(bw_pos, bw_neg, (first[0], lo, span_end, None, first[4]))
+            for j in group:
+               start, end = chunk[j][1], chunk[j][2]
+               result[j] = span[start - lo:end - lo] if first[4] == "+" else span[span_end - end:span_end - start]
+            group = []
+      if region is not None:
+         if group:
+            span_end = max(span_end, region[2])
+         else:
+            span_end = region[2]
+         group.append(i)
+   return result
+
+
+## LRU cache of decoded fixed-size bigwig tiles. Stands in for a pyBigWig handle:
+## values() is assembled from cached tiles, everything else is passed through
+class CachedBigWig(object):
+   TILE_SIZE = 1 << 16
+
+   def __init__(self, bw, max_tiles):
+      self.bw        = bw
+      self.max_tiles = max_tiles
+      self.tiles     = OrderedDict()
+
+   def __getattr__(self, name):
+      return getattr(self.bw, name)
+
+   def tile(self, chrom, index, chrom_len):
+      key = (chrom, index)
+      if key in self.tiles:
+         self.tiles.move_to_end(key)
+         return self.tiles[key]
+      start = index * self.TILE_SIZE
+      data  = self.bw.values(chrom, start, min(start + self.TILE_SIZE, chrom_len), numpy=True)
+      self.tiles[key] = data
+      if len(self.tiles) > self.max_tiles:
+         self.tiles.popitem(last=False)
+      return data
+
+   def values(self, chrom, start, end, numpy=True):
+      chrom_len = self.bw.chroms(chrom)
+      if not chrom_len or start < 0 or end > chrom_len or start >= end:
+         return self.bw.values(chrom, start, end, numpy=True)
+      first, last = start // self.TILE_SIZE, (end - 1) // self.TILE_SIZE
+      parts = [self.tile(chrom, t, chrom_len) for t in range(first, last + 1)]
+      data  = parts[0] if len(parts) == 1 else np.concatenate(parts)
+      return data[start - first * self.TILE_SIZE:end - first * self.TILE_SIZE]
+
+
+## Persistent cache of decoded bigwigs: one float32 .npy per chromosome, read back
+## through np.memmap. Entries live in <cache_dir>/<key>/, where the key hashes the
+## bigwig path, size and mtime, so a rewritten bigwig gets a fresh entry. Every open
+## handle holds a shared flock on <entry>/.lock, which keeps other processes from
+## evicting the entry while it is built or read. Stands in for a pyBigWig handle
+## like CachedBigWig
+class MemmapBigWig(object):
+   BLOCK = 1 << 23
+
+   def __init__(self, bw, filename, cache_dir, max_bytes=0):
+      st  = os.stat(filename)
+      key = hashlib.sha1(('%s\t%d\t%d' % (os.path.abspath(filename), st.st_size, st.st_mtime_ns)).encode()).hexdigest()
+      self.bw        = bw
+      self.cache_dir = cache_dir
+      self.entry     = os.path.join(cache_dir, key)
+      self.max_bytes = max_bytes
+      self.source    = '%s\t%d\t%d\n' % (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+      self.arrays    = {}
+      self.lock      = None
+      self.open_entry()
+
+   def open_entry(self):
+      # An evicted entry is renamed away while its lock is held exclusively, so
+      # a lock that no longer belongs to <entry>/.lock means: start over
+      lock_path = os.path.join(self.entry, '.lock')
+      while True:
+         os.makedirs(self.entry, exist_ok=True)
+         try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+         except FileNotFoundError:
+            continue
+         fcntl.flock(fd, fcntl.LOCK_SH)
+         try:
+            current = os.path.samestat(os.fstat(fd), os.stat(lock_path))
+         except FileNotFoundError:
+            current = False
+         if current:
+            break
+         os.close(fd)
+      self.lock = fd
+      if not os.path.exists(os.path.join(self.entry, 'source.txt')):
+         with open(os.path.join(self.entry, 'source.txt'), 'w') as fh:
+            fh.write(self.source)
+      # The entry's mtime doubles as its last-use time for eviction
+      os.utime(self.entry)
+
+   def __getattr__(self, name):
+      return getattr(self.bw, name)
+
+   def close(self):
+      self.arrays = {}
+      if self.lock is not None:
+         os.close(self.lock)
+         self.lock = None
+      self.bw.close()
+
+   def chrom_array(self, chrom):
+      if chrom not in self.arrays:
+         path = os.path.join(self.entry, chrom.replace('/', '%2F') + '.npy')
+         if not os.path.exists(path):
+            self.build(chrom, path)
+         self.arrays[chrom] = np.load(path, mmap_mode='r')
+      return self.arrays[chrom]
+
+   def build(self, chrom, path):
+      # Decode in blocks into a temporary file that is renamed into place, so
+      # concurrent workers never see a partial chromosome
+      os.utime(self.entry)
+      length = self.bw.chroms(chrom)
+      tmp    = '%s.%d.tmp' % (path, os.getpid())
+      arr    = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(length,))
+      for start in range(0, length, self.BLOCK):
+         end = min(start + self.BLOCK, length)
+         arr[start:end] = self.bw.values(chrom, start, end, numpy=True)
+      arr.flush()
+      del arr
+      os.rename(tmp, path)
+      prune_cache(self.cache_dir, self.max_bytes)
+
+   def values(self, chrom, start, end, numpy=True):
+      chrom_len = self.bw.chroms(chrom)
+      if not chrom_len or start < 0 or end > chrom_len or start >= end:
+         return self.bw.values(chrom, start, end, numpy=True)
+      return self.chrom_array(chrom)[start:end]
+
+
+## Size of a cache entry in bytes; files may vanish while it is scanned
+def entry_size(entry):
+   size = 0
+   for name in os.listdir(entry):
+      try:
+         size += os.path.getsize(os.path.join(entry, name))
+      except FileNotFoundError:
+         pass
+   return size
+
+
+## Evict one cache entry unless a handle in any process holds its lock. The entry
+## is renamed out of place under an exclusive lock, then removed
+def evict_entry(cache_dir, entry):
+   try:
+      fd = os.open(os.path.join(entry, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+   except FileNotFoundError:
+      return False
+   try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+   except BlockingIOError:
+      os.close(fd)
+      return False
+   # Another process may have evicted and recreated the entry meanwhile
+   try:
+      current = os.path.samestat(os.fstat(fd), os.stat(os.path.join(entry, '.lock')))
+   except FileNotFoundError:
+      current = False
+   if not current:
+      os.close(fd)
+      return False
+   trash = tempfile.mkdtemp(prefix='.evict.', dir=cache_dir)
+   try:
+      os.rename(entry, os.path.join(trash, 'entry'))
+      evicted = True
+   except FileNotFoundError:
+      evicted = False
+   os.close(fd)
+   shutil.rmtree(trash, ignore_errors=True)
+   return evicted
+
+
+## Remove least recently used cache entries until the cache fits in max_bytes;
+## entries with an open handle in any process are kept
+def prune_cache(cache_dir, max_bytes):
+   if not max_bytes:
+      return
+   entries = []
+   for name in os.listdir(cache_dir):
+      entry = os.path.join(cache_dir, name)
+      if name.startswith('.') or not os.path.isdir(entry):
+         continue
+      try:
+         entries.append((os.path.getmtime(entry), entry_size(entry), entry))
+      except FileNotFoundError:
+         continue
+   total = sum(entry[1] for entry in entries)
+   for mtime, size, entry in sorted(entries):
+      if total <= max_bytes:
+         break
+      if evict_entry(cache_dir, entry):
+         total -= size
+
+
+## Open the positive and negative strand bigwig files, optionally behind the
+## persistent memmap cache or an in-memory tile cache
+def open_bigwigs(bw_pos_filename, bw_neg_filename, settings):
+   bw_pos = py.open( bw_pos_filename )
+   bw_neg = py.open( bw_neg_filename )
+   if settings['cache_dir']:
+      max_bytes = int(settings['cache_max_gb'] * (1 << 30))
+      bw_pos = MemmapBigWig(bw_pos, bw_pos_filename, settings['cache_dir'], max_bytes)
+      bw_neg = MemmapBigWig(bw_neg, bw_neg_filename, settings['cache_dir'], max_bytes)
+   elif settings['cache_tiles']:
+      bw_pos = CachedBigWig(bw_pos, settings['cache_tiles'])
+      bw_neg = CachedBigWig(bw_neg, settings['cache_tiles'])
+   return bw_pos, bw_neg
+
+
+## Strand-aware summary statistic over a region, or over N equal bins of it.
+## Unless exact is set, pyBigWig answers from the zoom levels (approximate)
+def fetch_stats(bw_pos, bw_neg, region, stat, bins=1, exact=False):
+   bw         = bw_pos if region[4] == "+" else bw_neg
+   range_data = np.array(bw.stats(region[0], region[1], region[2], type=stat, nBins=bins, exact=exact), dtype=np.float64)
+   if region[4] != "+":
+      range_data = range_data[::-1]
+   return np.nan_to_num(range_data)
+
+
+## Mean of each of nbins equal-width bins; bases outside the chromosome (NaN) are ignored
+def bin_means(values, nbins):
+   if nbins == 0:
+      return np.empty(0)
+   if len(values) == 0:
+      return np.full(nbins, np.nan)
+   edges = np.linspace(0, len(values), nbins + 1)
+   lo    = np.floor(edges[:-1]).astype(int)
+   hi    = np.maximum(np.ceil(edges[1:]).astype(int), lo + 1)
+   sums  = np.concatenate([[0], np.cumsum(np.nan_to_num(values))])
+   ns    = np.concatenate([[0], np.cumsum(np.isfinite(values))])
+   with np.errstate(invalid='ignore', divide='ignore'):
+      return (sums[hi] - sums[lo]) / (ns[hi] - ns[lo])
+
+
+## Scale a region to fixed upstream, body and downstream bins (computeMatrix-style).
+## With a body length of 0 the profile is centered on the 5' end of the region
+def fetch_scaled(bw_pos, bw_neg, region, upstream, downstream, body, bin_size):
+   chrom, start, end, strand = region[0], region[1], region[2], region[4]
+   bw = bw_pos if strand == "+" else bw_neg
+   if strand == "+":
+      anchor_lo, anchor_hi = start, (end if body else start)
+      lo, hi = anchor_lo - upstream, anchor_hi + downstream
+   else:
+      anchor_lo, anchor_hi = (start if body else end), end
+      lo, hi = anchor_lo - downstream, anchor_hi + upstream
+   range_data = np.full(hi - lo, np.nan)
+   a, b = max(lo, 0), min(hi, bw.chroms(chrom) or 0)
+   if b > a:
+      range_data[a - lo:b - lo] = np.nan_to_num(bw.values(chrom, a, b, numpy=True))
+   if strand != "+":
+      range_data = range_data[::-1]
+   n_body = len(range_data) - upstream - downstream
+   return np.concatenate([bin_means(range_data[:upstream], upstream // bin_size),
+                          bin_means(range_data[upstream:upstream + n_body], body // bin_size),
+                          bin_means(range_data[upstream + n_body:], downstream // bin_size)])
+
+
+## Values for one region according to the extraction settings
+def fetch_region(bw_pos, bw_neg, region, settings):
+   if settings['metagene']:
+      return fetch_scaled(bw_pos, bw_neg, region, settings['upstream'], settings['downstream'], settings['body_length'], settings['bin_size'])
+   if settings['stat']:
+      return fetch_stats(bw_pos, bw_neg, region, settings['stat'], settings['bins'], settings['exact'])
+   if settings['emit'] != 'all':
+      starts, ends, values = fetch_runs(bw_pos, bw_neg, region)
+      keep = values != 0
+      return starts[keep], ends[keep], values[keep]
+   if settings['sparse']:
+      return fetch_sparse_values(bw_pos, bw_neg, region)
+   return fetch_values(bw_pos, bw_neg, region)
+
+
+## Format one region as a single "name<TAB>value1<TAB>value2..." line
+def format_row(name, values):
+   return name + ''.join(['\t%r' % v for v in values.tolist()]) + '\n'
+
+
+## Encoded payloads for a chunk of regions, in chunk order
+def fetch_chunk(bw_pos, bw_neg, chunk, settings, sample=None):
+   if settings['coalesce'] and not (settings['metagene'] or settings['stat'] or settings['emit'] != 'all'):
+      values = fetch_coalesced(bw_pos, bw_neg, chunk, settings['merge_gap'], settings['sparse'])
+   else:
+      values = [fetch_region(bw_pos, bw_neg, region, settings) for region in chunk]
+   return [encode_values(settings, region, v, sample) for region, v in zip(chunk, values)]
+
+
+## Convert region values to the payload expected by the output writer.
+## In multi-sample mode text lines carry the sample after the region name
+def encode_values(settings, region, values, sample=None):
+   if settings['metagene']:
+      return values
+   if settings['format'] == 'array':
+      return values
+   if settings['format'] == 'text':
+      label = str(region[3]) if sample is None else str(region[3]) + '\t' + sample
+      if settings['stat']:
+         return format_row(label, values)
+      if settings['emit'] == 'nonzero':
+         offsets, values = expand_runs(*values)
+         return format_block(label, values, offsets)
+      if settings['emit'] == 'rle':
+         return format_block(label, values[2], values[0], values[1])
+      return format_block(label, values)
+   return np.asarray(values, dtype=np.float32)
+
+
+## Combine the per-sample payloads of one region
+def combine_samples(settings, parts):
+   if len(parts) == 1:
+      return parts[0]
+   if settings['format'] == 'text' and not settings['metagene']:
+      return ''.join(parts)
+   return np.stack(parts)
+
+
+## Read a sample sheet with (sample, pos.bw, neg.bw) rows; a header line is skipped
+def read_sample_sheet(path):
+   samples = []
+   fh = open_text(path)
+   for line in fh:
+      if not line.strip() or line.startswith('#'):
+         continue
+      fields = line.rstrip('\r\n').split('\t')
+      if len(fields) < 3:
+         raise ValueError('sample sheet lines need sample, pos.bw and neg.bw columns: %s' % line.rstrip())
+      if not samples and fields[0].lower() == 'sample':
+         continue
+      samples.append((fields[0], fields[1], fields[2]))
+   fh.close()
+   return samples
+
+
+## Settings shared by the serial path and the worker processes. The 'array'
+## format hands back the raw value arrays (used by the importable API)
+DEFAULT_SETTINGS = {'format'      : 'array',
+                    'stat'        : None,
+                    'bins'        : 1,
+                    'exact'       : False,
+                    'sparse'      : False,
+                    'emit'        : 'all',
+                    'coalesce'    : False,
+                    'merge_gap'   : 0,
+                    'cache_tiles' : 0,
+                    'cache_dir'   : None,
+                    'cache_max_gb': 0,
+                    'metagene'    : False,
+                    'upstream'    : 1000,
+                    'downstream'  : 1000,
+                    'body_length' : 1000,
+                    'bin_size'    : 10}
+
+def make_settings(**overrides):
+   unknown = set(overrides) - set(DEFAULT_SETTINGS)
+   if unknown:
+      raise TypeError('unknown setting(s): %s' % ', '.join(sorted(unknown)))
+   settings = dict(DEFAULT_SETTINGS, **overrides)
+   if settings['bins'] > 1 and not settings['stat']:
+      settings['stat'] = 'mean'
+   if settings['emit'] != 'all':
+      settings['sparse'] = True
+   return settings
+
+
+def extraction_settings(opt):
+   return make_settings(**dict((key, getattr(opt, key)) for key in DEFAULT_SETTINGS if key != 'bins'),
+                        bins=opt.bins if opt.bins else 1)
+
+
+## Group regions into lists of consecutive entries
+def chunked(regions, size):
+   chunk = []
+   for region in regions:
+      chunk.append(region)
+      if len(chunk) >= size:
+         yield chunk
+         chunk = []
+   if chunk:
+      yield chunk
+
+
+## Process state: bigwig handles are opened per sample on first use, so each
+## worker process opens its own
+_WORKER = {}
+
+def init_worker(samples, settings):
+   _WORKER['samples']  = samples
+   _WORKER['settings'] = settings
+   _WORKER['handles']  = {}
+
+
+def process_chunk(chunk, index, settings=None):
+   if index not in _WORKER['handles']:
+      sample, bw_pos_filename, bw_neg_filename = _WORKER['samples'][index]
+      _WORKER['handles'][index] = open_bigwigs(bw_pos_filename, bw_neg_filename, _WORKER['settings'])
+   bw_pos, bw_neg = _WORKER['handles'][index]
+   return fetch_chunk(bw_pos, bw_neg, chunk, settings or _WORKER['settings'], _WORKER['samples'][index][0])
+
+
+## Run an iterable in a background thread and hand its items over through a
+## bounded queue, in order. Exceptions are re-raised in the consuming thread
+def threaded(iterable, depth):
+   items = queue.Queue(maxsize=depth)
+   stop  = threading.Event()
+
+   def produce():
+      try:
+         for item in iterable:
+            while not stop.is_set():
+               try:
+                  items.put(('item', item), timeout=0.1)
+                  break
+               except queue.Full:
+                  pass
+            if stop.is_set():
+               return
+         items.put(('done', None))
+      except BaseException as e:
+         items.put(('error', e))
+
+   thread = threading.Thread(target=produce)
+   thread.daemon = True
+   thread.start()
+   try:
+      while True:
+         kind, item = items.get()
+         if kind == 'done':
+            break
+         if kind == 'error':
+            raise item
+         yield item
+   finally:
+      stop.set()
+
+
+## Write (region, payload) items from a background thread behind a bounded queue.
+## The first item is taken before the thread starts: with worker processes that
+## creates the pool, so fork() runs while the process is still single-threaded
+def write_all(out, items, depth=0):
+   if depth <= 0:
+      for region, payload in items:
+         out.write(region, payload)
+      return
+   items = iter(items)
+   first = next(items, None)
+   if first is None:
+      return
+   pending = queue.Queue(maxsize=depth)
+   pending.put(first)
+   failure = []
+
+   def consume():
+      try:
+         while True:
+            item = pending.get()
+            if item is None:
+               return
+            out.write(*item)
+      except BaseException as e:
+         failure.append(e)
+         # Keep draining so the producer never blocks on a full queue
+         while pending.get() is not None:
+            pass
+
+   thread = threading.Thread(target=consume)
+   thread.daemon = True
+   thread.start()
+   try:
+      for item in items:
+         if failure:
+            break
+         pending.put(item)
+   finally:
+      pending.put(None)
+      thread.join()
+   if failure:
+      raise failure[0]
+
+
+## Yield (region, payload) in input order, computed serially or by a process pool.
+## Samples are (name, pos.bw, neg.bw) tuples; a single unnamed sample gives the
+## classic output, several samples are combined per region in sheet order.
+## With a queue depth, the serial path fetches chunks in a background thread while
+## the previous chunk is encoded, keeping at most depth chunks in flight
+def extract_regions(regions, samples, settings, threads=1, chunk_size=256, depth=0):
+   if threads <= 1:
+      init_worker(samples, settings)
+      if depth <= 0:
+         for chunk in chunked(regions, chunk_size):
+            results = [process_chunk(chunk, i) for i in range(len(samples))]
+            for region, parts in zip(chunk, zip(*results)):
+               yield region, combine_samples(settings, parts)
+         return
+      raw     = dict(settings, format='array')
+      fetched = ((chunk, [process_chunk(chunk, i, raw) for i in range(len(samples))]) for chunk in chunked(regions, chunk_size))
+      for chunk, results in threaded(fetched, depth):
+         for region, values in zip(chunk, zip(*results)):
+            parts = [encode_values(settings, region, v, sample[0]) for v, sample in zip(values, samples)]
+            yield region, combine_samples(settings, parts)
+      return
+
+   # Keep a bounded window of chunks in flight; each chunk is one job per sample,
+   # and chunks are collected in submission order
+   pool    = multiprocessing.Pool(threads, init_worker, (samples, settings))
+   pending = deque()
+   try:
+      for chunk in chunked(regions, chunk_size):
+         pending.append((chunk, [pool.apply_async(process_chunk, (chunk, i)) for i in range(len(samples))]))
+         if len(pending) >= max(2, 2 * threads // len(samples)):
+            done, jobs = pending.popleft()
+            for region, parts in zip(done, zip(*[job.get() for job in jobs])):
+               yield region, combine_samples(settings, parts)
+      while pending:
+         done, jobs = pending.popleft()
+         for region, parts in zip(done, zip(*[job.get() for job in jobs])):
+            yield region, combine_samples(settings, parts)
+      pool.close()
+   finally:
+      pool.terminate()
+      pool.join()
+
+
+## Normalize a region to a (chrom, start, end, name, strand) tuple. Accepts
+## (chrom, start, end), (chrom, start, end, name), the 5-tuples produced by
+## read_regions, or bed6 rows (strand in column 6, extra columns ignored).
+## Regions without a strand get DEFAULT_STRAND, like bed3/bed4 lines in read_regions
+def as_region(region):
+   n = len(region)
+   if n == 3:
+      return (region[0], int(region[1]), int(region[2]), '.', DEFAULT_STRAND)
+   if n == 4:
+      return (region[0], int(region[1]), int(region[2]), region[3], DEFAULT_STRAND)
+   if n == 5:
+      return (region[0], int(region[1]), int(region[2]), region[3], region[4])
+   if n >= 6:
+      return (region[0], int(region[1]), int(region[2]), region[3], region[5])
+   raise ValueError('region needs chrom, start and end (optionally name and strand), got %d field(s): %r' % (n, tuple(region)))
+
+
+## Importable API
+class BigWigCoverage(object):
+   """
+   Strand-aware coverage from a pair of positive/negative strand bigwig files.
+
+   Minus-strand values come from the negative strand file and are reversed, so
+   offset 0 is always the 5' end of the region. Regions without a strand
+   (bed3/bed4 lines, 3- or 4-tuples) are read as DEFAULT_STRAND ('+').
+   Keyword arguments are the extraction settings (see DEFAULT_SETTINGS); they
+   mirror the command line options, e.g. stat='max', bins=20, sparse=True,
+   coalesce=True, cache_dir=...
+   """
+
+   def __init__(self, bw_pos_filename, bw_neg_filename, **settings):
+      self.filenames = (bw_pos_filename, bw_neg_filename)
+      self.settings  = make_settings(**settings)
+      self.bw_pos, self.bw_neg = open_bigwigs(bw_pos_filename, bw_neg_filename, self.settings)
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *exc):
+      self.close()
+
+   def close(self):
+      self.bw_pos.close()
+      self.bw_neg.close()
+
+   def values(self, chrom, start, end, strand=DEFAULT_STRAND):
+      """Per-base values of one region; missing data is 0."""
+      return fetch_values(self.bw_pos, self.bw_neg, (chrom, start, end, None, strand))
+
+   def stats(self, chrom, start, end, strand=DEFAULT_STRAND, stat='mean', bins=1, exact=False):
+      """Summary statistic of one region, or of N equal-width bins of it."""
+      return fetch_stats(self.bw_pos, self.bw_neg, (chrom, start, end, None, strand), stat, bins, exact)
+
+   def runs(self, chrom, start, end, strand=DEFAULT_STRAND):
+      """Covered runs of one region as (start, end, value) offset arrays."""
+      return fetch_runs(self.bw_pos, self.bw_neg, (chrom, start, end, None, strand))
+
+   def query(self, regions, threads=1, chunk_size=256):
+      """
+      Yield (region, values) for each region, in input order. The values depend
+      on the settings: per-base arrays by default, statistics with stat/bins,
+      run tuples with emit, and scaled profiles with metagene. With threads > 1
+      the regions are processed by a pool of worker processes.
+      """
+      regions = (as_region(region) for region in regions)
+      if threads <= 1:
+         for chunk in chunked(regions, chunk_size):
+            for item in zip(chunk, fetch_chunk(self.bw_pos, self.bw_neg, chunk, self.settings)):
+               yield item
+      else:
+         for item in extract_regions(regions, [(None,) + self.filenames], self.settings, threads, chunk_size):
+            yield item
+
+
+## Generator shortcut: yield (region, values) for regions from a bigwig pair
+def coverage(bw_pos_filename, bw_neg_filename, regions, threads=1, **settings):
+   with BigWigCoverage(bw_pos_filename, bw_neg_filename, **settings) as cov:
+      for item in cov.query(regions, threads):
+         yield item
+
+
+## Append rows to a .npy file; the shape in the header is fixed up on close
+class NpyAppender(object):
+   HEADER_LEN = 128
+
+   def __init__(self, path, dtype, row_shape=()):
+      self.fh        = open(path, 'wb')
+      self.dtype     = np.dtype(dtype)
+      self.row_shape = tuple(row_shape)
+      self.rows      = 0
+      self._write_header()
+
+   def _write_header(self):
+      magic  = np.lib.format.magic(1, 0)
+      header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+         np.lib.format.dtype_to_descr(self.dtype), (self.rows,) + self.row_shape)
+      header = header.ljust(self.HEADER_LEN - len(magic) - 3) + '\n'
+      self.fh.seek(0)
+      self.fh.write(magic + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+   def append(self, arr):
+      arr = np.ascontiguousarray(arr, dtype=self.dtype).reshape((-1,) + self.row_shape)
+      self.fh.write(arr.tobytes())
+      self.rows += arr.shape[0]
+
+   def close(self):
+      self._write_header()
+      self.fh.close()
+
+
+## Long-format text output (name, offset, value)
+class TextWriter(object):
+   def __init__(self, path):
+      if path == '-':
+         self.out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1 << 20)
+      else:
+         self.out = open(path, 'w', 1 << 20)
+
+   def write(self, region, block):
+      self.out.write(block)
+
+   def close(self):
+      self.out.close()
+
+
+## Region x position matrix base class; keeps the region index. With several
+## samples each region holds a samples x position block: padded matrices get a
+## sample axis, ragged values store the block row-major (length = positions per sample)
+class MatrixWriter(object):
+   INDEX_FIELDS = ['chrom', 'start', 'end', 'name', 'strand', 'offset', 'length']
+
+   def __init__(self, width=None, samples=None):
+      self.width   = width
+      self.samples = samples
+      self.offset  = 0
+
+   def row_shape(self):
+      if self.width is None:
+         return ()
+      return (len(self.samples), self.width) if self.samples else (self.width,)
+
+   def row(self, values):
+      # Padded rows are NaN-filled beyond the region end
+      values = np.asarray(values, dtype=np.float32)
+      if self.width is None:
+         return values
+      if values.shape[-1] > self.width:
+         raise ValueError('region of %d bp exceeds matrix width %d' % (values.shape[-1], self.width))
+      padded = np.full(values.shape[:-1] + (self.width,), np.nan, dtype=np.float32)
+      padded[..., :values.shape[-1]] = values
+      return padded
+
+   def index_entry(self, region, values):
+      length = np.shape(values)[-1]
+      entry  = (region[0], int(region[1]), int(region[2]), str(region[3]), region[4], self.offset, length)
+      self.offset += np.size(values) if self.width is None else 1
+      return entry
+
+
+## NPY output: <prefix>.npy holds the matrix, <prefix>.index.tsv the regions
+## and <prefix>.samples.txt the sample order (multi-sample mode)
+class NpyWriter(MatrixWriter):
+   def __init__(self, prefix, width=None, samples=None):
+      MatrixWriter.__init__(self, width, samples)
+      self.matrix = NpyAppender(prefix + '.npy', np.float32, self.row_shape())
+      self.index  = open(prefix + '.index.tsv', 'w')
+      self.index.write('\t'.join(self.INDEX_FIELDS) + '\n')
+      if samples:
+         with open(prefix + '.samples.txt', 'w') as fh:
+            fh.write('\n'.join(samples) + '\n')
+
+   def write(self, region, values):
+      self.matrix.append(self.row(values))
+      self.index.write('\t'.join(map(str, self.index_entry(region, values))) + '\n')
+
+   def close(self):
+      self.matrix.close()
+      self.index.close()
+
+
+## NPZ output; the matrix is streamed to a temporary .npy and packed on close
+class NpzWriter(MatrixWriter):
+   def __init__(self, path, width=None, samples=None):
+      MatrixWriter.__init__(self, width, samples)
+      self.path    = path
+      self.tmpdir  = tempfile.mkdtemp(prefix='bwcov.', dir=os.path.dirname(os.path.abspath(path)))
+      self.matrix  = NpyAppender(os.path.join(self.tmpdir, 'values.npy'), np.float32, self.row_shape())
+      self.entries = []
+
+   def write(self, region, values):
+      self.matrix.append(self.row(values))
+      self.entries.append(self.index_entry(region, values))
+
+   def close(self):
+      self.matrix.close()
+      columns = list(zip(*self.entries)) if self.entries else [[]] * len(self.INDEX_FIELDS)
+      try:
+         with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            zf.write(self.matrix.fh.name, 'values.npy')
+            for field, column in zip(self.INDEX_FIELDS, columns):
+               arr = np.array(column, dtype=np.int64 if field in ('start', 'end', 'offset', 'length') else str)
+               with zf.open(field + '.npy', 'w', force_zip64=True) as fh:
+                  np.lib.format.write_array(fh, arr, allow_pickle=False)
+            if self.samples:
+               with zf.open('samples.npy', 'w', force_zip64=True) as fh:
+                  np.lib.format.write_array(fh, np.array(self.samples, dtype=str), allow_pickle=False)
+      finally:
+         shutil.rmtree(self.tmpdir)
+
+
+## Parquet output (requires pyarrow); one row per region, written in row groups.
+## Multi-sample blocks are flattened row-major; the sample order is in the schema metadata
+class ParquetWriter(MatrixWriter):
+   BATCH = 1024
+
+   def __init__(self, path, width=None, samples=None):
+      MatrixWriter.__init__(self, width, samples)
+      try:
+         import pyarrow as pa
+         import pyarrow.parquet as pq
+      except ImportError:
+         raise ImportError('parquet output requires the pyarrow module')
+      self.pa     = pa
+      self.size   = None if width is None else int(np.prod(self.row_shape()))
+      value_type  = pa.list_(pa.float32()) if width is None else pa.list_(pa.float32(), self.size)
+      metadata    = {'samples': '\t'.join(samples)} if samples else None
+      self.schema = pa.schema([('chrom', pa.string()), ('start', pa.int64()), ('end', pa.int64()),
+                               ('name', pa.string()), ('strand', pa.string()), ('values', value_type)], metadata=metadata)
+      self.writer = pq.ParquetWriter(path, self.schema)
+      self.batch  = []
+
+   def write(self, region, values):
+      self.batch.append((region[0], int(region[1]), int(region[2]), str(region[3]), region[4], self.row(values).ravel()))
+      if len(self.batch) >= self.BATCH:
+         self.flush()
+
+   def flush(self):
+      if not self.batch:
+         return
+      columns = list(zip(*self.batch))
+      arrays  = [self.pa.array(col, type=field.type) for col, field in zip(columns[:5], self.schema)]
+      values  = self.pa.array(np.concatenate(columns[5]), type=self.pa.float32())
+      lengths = np.cumsum([0] + [len(v) for v in columns[5]]).astype(np.int32)
+      if self.width is None:
+         arrays.append(self.pa.ListArray.from_arrays(self.pa.array(lengths), values))
+      else:
+         arrays.append(self.pa.FixedSizeListArray.from_arrays(values, self.size))
+      self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+      self.batch = []
+
+   def close(self):
+      self.flush()
+      self.writer.close()
+
+
+## Metagene profile: per-bin running sums and counts across all regions, plus a
+## reservoir sample of whole region profiles from which bin quantiles are taken.
+## One reservoir slot decision is shared by all bins (and samples) of a region
+class MetageneWriter(object):
+   def __init__(self, path, settings, quantiles, sketch_size, samples=None, seed=0):
+      self.path        = path
+      self.settings    = settings
+      self.quantiles   = quantiles
+      self.sketch_size = sketch_size
+      self.samples     = samples
+      self.rng         = np.random.RandomState(seed)
+      nbins            = (settings['upstream'] + settings['body_length'] + settings['downstream']) // settings['bin_size']
+      shape            = (len(samples) if samples else 1, nbins)
+      self.sum         = np.zeros(shape)
+      self.count       = np.zeros(shape, dtype=np.int64)
+      self.sketch      = np.full((min(sketch_size, 1024),) + shape, np.nan)
+      self.seen        = 0
+
+   def write(self, region, values):
+      values = np.atleast_2d(values)
+      valid  = np.isfinite(values)
+      self.sum[valid] += values[valid]
+      self.count      += valid
+      slot = self.seen if self.seen < self.sketch_size else self.rng.randint(0, self.seen + 1)
+      if slot < self.sketch_size:
+         if slot >= len(self.sketch):
+            grown = np.full((min(2 * len(self.sketch), self.sketch_size),) + self.sketch.shape[1:], np.nan)
+            grown[:len(self.sketch)] = self.sketch
+            self.sketch = grown
+         self.sketch[slot] = values
+      self.seen += 1
+
+   def labels(self):
+      up, body, down, size = self.settings['upstream'], self.settings['body_length'], self.settings['downstream'], self.settings['bin_size']
+      segments  = ['upstream'] * (up // size) + ['body'] * (body // size) + ['downstream'] * (down // size)
+      positions = list(range(-up, body + down, size))
+      return segments, positions
+
+   def close(self):
+      with np.errstate(invalid='ignore', divide='ignore'):
+         mean = self.sum / self.count
+      with warnings.catch_warnings():
+         warnings.simplefilter('ignore', RuntimeWarning)
+         if self.seen and self.quantiles:
+            quants = np.nanquantile(self.sketch[:min(self.seen, self.sketch_size)], self.quantiles, axis=0)
+         else:
+            quants = np.full((len(self.quantiles),) + self.sum.shape, np.nan)
+      segments, positions = self.labels()
+      out    = TextWriter(self.path)
+      header = ['bin', 'position', 'segment', 'n', 'sum', 'mean'] + ['q%g' % q for q in self.quantiles]
+      out.write(None, '\t'.join((['sample'] if self.samples else []) + header) + '\n')
+      for s in range(self.sum.shape[0]):
+         for i in range(self.sum.shape[1]):
+            fields = [i, positions[i], segments[i], self.count[s, i], self.sum[s, i].item(), mean[s, i].item()] + [q.item() for q in quants[:, s, i]]
+            out.write(None, '\t'.join(map(str, ([self.samples[s]] if self.samples else []) + fields)) + '\n')
+      out.close()
+
+
+## Pick the output writer for the requested format
+def open_writer(fmt, path, width=None, samples=None):
+   if fmt == 'text':
+      return TextWriter(path)
+   if path == '-':
+      raise ValueError('an output file (-o) is required for %s output' % fmt)
+   if fmt == 'npy':
+      return NpyWriter(path[:-4] if path.endswith('.npy') else path, width, samples)
+   if fmt == 'npz':
+      return NpzWriter(path, width, samples)
+   return ParquetWriter(path, width, samples)
+
+
 ## Parse options
 def parse_options(argv):
    from optparse import OptionParser, OptionGroup
    parser   = OptionParser()
    required = OptionGroup(parser, 'MANDATORY')
-   required.add_option('-r', '--region_file', dest='bed_filename',    metavar='FILE.bed', help='Region list in bed6 format', default='-')
+   required.add_option('-r', '--region_file', dest='bed_filename',    metavar='FILE.bed', help='Region list in bed6 format; lines without a strand column are read as + strand', default='-')
    required.add_option('-p', '--bw_pos_file', dest='bw_pos_filename', metavar='FILE.bw',  help='Bigwig file with postive strand coverage', default='-')
    required.add_option('-n', '--bw_neg_file', dest='bw_neg_filename', metavar='FILE.bw',  help='Bigwig file with negative strand coverage', default='-')
    
+   required.add_option('-S', '--sample_sheet', dest='sample_sheet',   metavar='FILE.tsv', help='Tab-delimited sample sheet with sample, pos.bw and neg.bw columns; replaces -p/-n', default=None)
    parser.add_option_group(required)
-   (options, args) = parser.parse_args()
 
-   if len(argv) < 6:
+   output = OptionGroup(parser, 'OUTPUT')
+   output.add_option('-o', '--output',  dest='output',  metavar='FILE',   help='Output file, or prefix for npy output (default: stdout)', default='-')
+   output.add_option('-f', '--format',  dest='format',  metavar='FORMAT', help='Output format: text, npy, npz or parquet (default: text)', default='text',
+                     type='choice', choices=['text', 'npy', 'npz', 'parquet'])
+   output.add_option('-l', '--layout',  dest='layout',  metavar='LAYOUT', help='Matrix layout for binary formats: ragged or padded (default: ragged)', default='ragged',
+                     type='choice', choices=['ragged', 'padded'])
+   output.add_option('-w', '--width',   dest='width',   metavar='INT',    help='Row width for the padded layout (default: longest region)', type='int', default=None)
+   parser.add_option_group(output)
+
+   sparse = OptionGroup(parser, 'SPARSE')
+   sparse.add_option('--sparse', dest='sparse', action='store_true', help='Build values from the covered intervals only; faster for mostly empty bigwigs', default=False)
+   sparse.add_option('-e', '--emit', dest='emit', metavar='MODE', help='Text lines to emit: all positions, nonzero positions only, or rle runs (name, start, end, value) (default: all)', default='all',
+                     type='choice', choices=['all', 'nonzero', 'rle'])
+   parser.add_option_group(sparse)
+
+   summary = OptionGroup(parser, 'SUMMARY')
+   summary.add_option('-s', '--stat',  dest='stat',  metavar='STAT', help='Output one summary value per region (or bin) instead of per-base values: mean, max, min, sum or coverage', default=None,
+                      type='choice', choices=['mean', 'max', 'min', 'sum', 'coverage'])
+   summary.add_option('-b', '--bins',  dest='bins',  metavar='INT',  help='Summarize each region in N equal-width bins (default statistic: mean)', type='int', default=None)
+   summary.add_option('--exact',       dest='exact', action='store_true', help='Compute summaries from full-resolution data instead of the zoom levels', default=False)
+   parser.add_option_group(summary)
+
+   metagene = OptionGroup(parser, 'METAGENE')
+   metagene.add_option('-m', '--metagene',  dest='metagene',    action='store_true', help='Output only the aggregated profile across all regions', default=False)
+   metagene.add_option('--upstream',        dest='upstream',    metavar='INT', help='Upstream flank in bp (default: 1000)', type='int', default=1000)
+   metagene.add_option('--downstream',      dest='downstream',  metavar='INT', help='Downstream flank in bp (default: 1000)', type='int', default=1000)
+   metagene.add_option('--body-length',     dest='body_length', metavar='INT', help='Length in bp each region body is scaled to; 0 centers the profile on the region 5\' end (default: 1000)', type='int', default=1000)
+   metagene.add_option('--bin-size',        dest='bin_size',    metavar='INT', help='Profile bin size in bp (default: 10)', type='int', default=10)
+   metagene.add_option('--quantiles',       dest='quantiles',   metavar='LIST', help='Comma-separated per-bin quantiles to report (default: 0.25,0.5,0.75)', default='0.25,0.5,0.75')
+   metagene.add_option('--sketch-size',     dest='sketch_size', metavar='INT', help='Number of region profiles sampled for the quantiles (default: 10000)', type='int', default=10000)
+   parser.add_option_group(metagene)
+
+   io_opts = OptionGroup(parser, 'I/O')
+   io_opts.add_option('--coalesce',    dest='coalesce',    action='store_true', help='Fetch overlapping regions on the same strand once per chunk and slice them from the shared span', default=False)
+   io_opts.add_option('--merge-gap',   dest='merge_gap',   metavar='INT', help='Also coalesce regions up to this many bp apart (default: 0)', type='int', default=0)
+   io_opts.add_option('--cache-tiles', dest='cache_tiles', metavar='INT', help='Keep up to N decoded 64 kb tiles per strand in an LRU cache (default: 0, off)', type='int', default=0)
+   io_opts.add_option('--cache-dir',   dest='cache_dir',   metavar='DIR', help='Decode each bigwig once into per-chromosome .npy files in DIR and read regions through memory maps', default=None)
+   io_opts.add_option('--cache-max-gb', dest='cache_max_gb', metavar='FLOAT', help='Evict least recently used bigwigs from the cache above this size; bigwigs open in any process are kept (default: 0, no limit)', type='float', default=0)
+   io_opts.add_option('--cache-build', dest='cache_build', action='store_true', help='Only fill the cache with all chromosomes of the bigwig files, then exit', default=False)
+   parser.add_option_group(io_opts)
+
+   parallel = OptionGroup(parser, 'PARALLEL')
+   parallel.add_option('-t', '--threads', '--processes', dest='threads', metavar='INT', help='Number of worker processes (default: 1)', type='int', default=1)
+   parallel.add_option('--chunk-size', dest='chunk_size', metavar='INT', help='Regions per worker job (default: 256)', type='int', default=256)
+   parallel.add_option('--queue-depth', dest='queue_depth', metavar='INT', help='Chunks buffered between the read, format and write threads; 0 runs them in turn (default: 4)', type='int', default=4)
+   parser.add_option_group(parallel)
+   (options, args) = parser.parse_args(argv[1:])
+
+   if not options.sample_sheet and (options.bw_pos_filename == '-' or options.bw_neg_filename == '-'):
       parser.print_help()
       sys.exit(2)
 
+   if options.cache_build and not options.cache_dir:
+      parser.error('--cache-build requires --cache-dir')
+
+   if options.bins and not options.stat:
+      options.stat = 'mean'
+
+   if options.emit != 'all':
+      if options.format != 'text' or options.stat or options.metagene:
+         parser.error('--emit nonzero/rle only applies to per-base text output')
+      options.sparse = True
+
+   if options.metagene:
+      if options.format != 'text' or options.stat:
+         parser.error('--metagene writes a text profile and cannot be combined with --format or --stat/--bins')
+      if options.bin_size < 1 or any(x < 0 or x % options.bin_size for x in (options.upstream, options.downstream, options.body_length)):
+         parser.error('--upstream, --downstream and --body-length must be non-negative multiples of --bin-size')
+      try:
+         options.quantiles = [float(q) for q in options.quantiles.split(',') if q.strip()]
+      except ValueError:
+         parser.error('--quantiles must be a comma-separated list of numbers')
+      if any(q < 0 or q > 1 for q in options.quantiles):
+         parser.error('--quantiles must be between 0 and 1')
+
    options.parser = parser
    return options
 
@@ -36,33 +1111,75 @@ def parse_options(argv):
 # MAIN #
 ########
  
-def main():
+def main(argv=None):
+   # Ignore SIGPIPE and handle it quietly (e.g. when piped into head)
+   signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
    # get command line options
-   opt = parse_options(sys.argv)
+   opt = parse_options(sys.argv if argv is None else argv)
    
-   # Test if all files are accessible and readable
-   d = vars(opt)
-   for key in ["bed_filename", "bw_pos_filename", "bw_neg_filename"]:
-      if not ( os.path.isfile(d[key]) and os.access(d[key], os.R_OK) ):
-         print >> sys.stderr, 'ERROR: file "%s" does not exist or is not readable.' % d[key]
+   # Test if the region file and sample sheet are accessible and readable; regions may come from stdin
+   for filename in [opt.bed_filename, opt.sample_sheet]:
+      if filename is None or filename == '-':
+         continue
+      if not ( os.path.isfile(filename) and os.access(filename, os.R_OK) ):
+         sys.stderr.write('ERROR: file "%s" does not exist or is not readable.\n' % filename)
          sys.exit(1)
 
-   # Open positive and negative strand bigwig files
-   bw_pos = py.open( opt.bw_pos_filename )
-   bw_neg = py.open( opt.bw_neg_filename )
+   # Collect the samples: one unnamed -p/-n pair, or the rows of the sample sheet
+   if opt.sample_sheet:
+      samples = read_sample_sheet(opt.sample_sheet)
+      names   = [sample[0] for sample in samples]
+   else:
+      samples = [(None, opt.bw_pos_filename, opt.bw_neg_filename)]
+      names   = None
+   if not samples:
+      sys.stderr.write('ERROR: sample sheet "%s" lists no samples.\n' % opt.sample_sheet)
+      sys.exit(1)
+
+   # Test if all bigwig files are accessible and readable
+   for sample in samples:
+      for filename in sample[1:]:
+         if not ( os.path.isfile(filename) and os.access(filename, os.R_OK) ):
+            sys.stderr.write('ERROR: file "%s" does not exist or is not readable.\n' % filename)
+            sys.exit(1)
 
-   # Open bed file with regions and output count data per region position
-   range_data = []
-   df = pd.read_csv( opt.bed_filename, header=None, names=["chr","start","stop","name","score","strand"], sep="\t")
-   for row in df.itertuples():
-      if row[6] == "+":
-         range_data = bw_pos.values(row[1], row[2], row[3])
+   # Fill the coverage cache without extracting any regions
+   if opt.cache_build:
+      settings = extraction_settings(opt)
+      for sample in samples:
+         for bw in open_bigwigs(sample[1], sample[2], settings):
+            for chrom in bw.chroms():
+               bw.chrom_array(chrom)
+      sys.exit(0)
+
+   # Padded matrices need a row width; a region file (not stdin) can be pre-scanned for it.
+   # Summaries always produce a fixed number of columns per region
+   width = None
+   if opt.stat:
+      width = opt.bins if opt.bins else 1
+   elif opt.format != 'text' and opt.layout == 'padded':
+      if opt.width:
+         width = opt.width
+      elif opt.bed_filename != '-':
+         width = max_region_length(opt.bed_filename)
       else:
-         range_data = list(reversed( bw_neg.values(row[1], row[2], row[3]) ) )
-      range_data = np.nan_to_num(range_data)
-      for i in range(0, len(range_data) ):
-         print "\t".join([str(row[4]), str(i), str(range_data[i])])
-      
+         sys.stderr.write('ERROR: --width is required for padded output when regions are read from stdin.\n')
+         sys.exit(1)
+
+   # Stream regions from the bed file and write count data per region position
+   settings = extraction_settings(opt)
+   if opt.metagene:
+      out = MetageneWriter(opt.output, settings, opt.quantiles, opt.sketch_size, names)
+   else:
+      try:
+         out = open_writer(opt.format, opt.output, width, names)
+      except (ValueError, ImportError) as e:
+         sys.stderr.write('ERROR: %s.\n' % e)
+         sys.exit(1)
+   items = extract_regions(read_regions(opt.bed_filename), samples, settings, opt.threads, opt.chunk_size, opt.queue_depth)
+   write_all(out, items, opt.queue_depth * opt.chunk_size)
+   out.close()
       
 if __name__ == "__main__":
    main()
@@ -5,6 +5,10 @@ import argparse
 import subprocess
 import os
 
+# Shared annotation readers (lib/python in a git checkout)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib', 'python'))
+from omics_toolkit.annotation import read_gff, read_gff_sequences
+
 def colorstr(rgb): return "#%02x%02x%02x" % (rgb[0],rgb[1],rgb[2])
 
 
@@ -402,42 +406,14 @@ def reverse_compliment(seq):
 
 
 def get_genes_gff(gff_file):
-    with open(gff_file) as gff:
-        gene_dict = {}
-        seqDict = {}
-        getseq = False
-        for line in gff:
-            if line.startswith('#'):
-                pass
-            elif line.startswith('>'):
-                getseq = True
-                name = line.split()[0][1:]
-                seqDict[name] = ''
-            elif getseq:
-                seqDict[name] += line.rstrip()
-            else:
-                contig, method, feature, start, stop, score, strand, phase, extra = line.rstrip().split('\t')
-                if not contig in gene_dict:
-                    gene_dict[contig] = []
-                genes = gene_dict[contig]
-                gene= 'none'
-                uniprot = 'none'
-                product = 'none'
-                seq = 'none'
-                locus_tag = 'none'
-                for i in extra.split(';'):
-                    if i.startswith('Name='):
-                        gene = i.split('=')[1]
-                    elif i.startswith('locus_tag'):
-                        locus_tag = i.split('=')[1]
-                    elif i.startswith('product'):
-                        product = i.split('=')[1]
-                    elif i.startswith('locus_tag'):
-                        locus_tag = i.split('=')[1]
-                if feature == 'CDS':
-                    genes.append((int(start), int(stop), strand, gene, locus_tag, seq, product, uniprot))
-    return gene_dict, seqDict
-
+    gene_dict = {}
+    for rec in read_gff(gff_file):
+        genes = gene_dict.setdefault(rec.chrom, [])
+        if rec.feature == 'CDS':
+            attrs = rec.attributes
+            genes.append((rec.start, rec.end, rec.strand, attrs.get('Name', 'none'), attrs.get('locus_tag', 'none'),
+                          'none', attrs.get('product', 'none'), 'none'))
+    return gene_dict, read_gff_sequences(gff_file)
 
 
 
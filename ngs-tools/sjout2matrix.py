@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+##################
+# IMPORT MODULES #
+##################
+
+import sys
+import argparse
+import logging
+import signal
+import heapq
+import itertools
+import multiprocessing
+import tempfile
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Shared helpers (lib/python in a git checkout)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'lib' / 'python'))
+from omics_toolkit.annotation import open_text
+from omics_toolkit.bgzf import open_output
+from omics_toolkit.extsort import ExternalSorter, parse_size
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# Ignore SIGPIPE and handle it quietly
+signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+#############
+# FUNCTIONS #
+#############
+
+def is_interactive():
+    """Check if we're in an interactive session (e.g. Jupyter)."""
+    import __main__ as main
+    return not hasattr(main, '__file__')
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare an annotated junction set (e.g. from annots2sjout.py) against many STAR "
+            "SJ.out.tab files and write a junction x sample count matrix.\n\n"
+            "Junctions are matched on (chrom, start, end, strand). Every file is sorted once "
+            "(in parallel, within --max-memory) and all files are then combined in a single "
+            "sorted merge-join, so memory does not grow with the number of junctions. With more "
+            "files than --max-open-files the samples are first merged in groups.\n\n"
+            "Output columns:\n"
+            " 1 chrom\n 2 intron start (1-based)\n 3 intron end (1-based)\n"
+            " 4 strand (0: undefined, 1: +, 2: -)\n 5 motif\n"
+            " 6 annotated (1: in the annotated set, 0: novel)\n"
+            " 7.. read count per sample (see --count)"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--annotated', required=True,
+                        help='Annotated junctions in SJ.out.tab format (plain or gzipped).')
+    parser.add_argument('sj', nargs='*',
+                        help='STAR SJ.out.tab files (plain or gzipped).')
+    parser.add_argument('--sj-list', default=None,
+                        help="File with one SJ.out.tab path per line, optionally preceded by a "
+                             "sample name and a tab. Default sample names are the file names "
+                             "without .SJ.out.tab(.gz).")
+    parser.add_argument('-o', '--out', required=True,
+                        help='Output matrix path (bgzip compressed if it ends in .gz).')
+    parser.add_argument('--count', choices=['unique', 'multi', 'total'], default='unique',
+                        help="Reads to report: unique (col 7), multi-mapping (col 8) or their sum. "
+                             "Default: unique.")
+    parser.add_argument('--observed-only', action='store_true',
+                        help='Leave out annotated junctions without reads in any sample.')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='Worker processes for sorting the input files; also bgzip threads. Default: 1.')
+    parser.add_argument('--max-memory', type=parse_size, default=None, metavar='SIZE',
+                        help="Approximate memory budget shared by the sorting workers (e.g. 500M, 4G; "
+                             "plain numbers are MB). Default: sort each file in memory.")
+    parser.add_argument('--max-open-files', type=int, default=None, metavar='N',
+                        help="Files to merge at once. Default: the open file limit (ulimit -n) "
+                             "minus a reserve for the output and worker pipes.")
+    parser.add_argument('--tmp-dir', default=None,
+                        help='Directory for the sorted temporary files. Default: system temporary directory.')
+
+    # Show help if no args when running from CLI; empty args in notebooks.
+    if is_interactive():
+        args = parser.parse_args('')
+    else:
+        args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    if not args.sj and not args.sj_list:
+        parser.error("give SJ.out.tab files as arguments or with --sj-list")
+    if args.max_open_files is not None and args.max_open_files < 3:
+        parser.error("--max-open-files must be at least 3")
+    return args
+
+
+def sample_name(path):
+    name = Path(path).name
+    for suffix in ('.gz', '.tab', '.out', '.SJ', '_SJ'):
+        if name.endswith(suffix) and len(name) > len(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def read_samples(args):
+    """(sample name, path) for the positional files followed by --sj-list."""
+    samples = [(sample_name(path), path) for path in args.sj]
+    if args.sj_list:
+        with open_text(args.sj_list) as fh:
+            for line in fh:
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                samples.append((fields[0], fields[1]) if len(fields) > 1 else (sample_name(fields[0]), fields[0]))
+    return samples
+
+
+# Rough in-memory footprint of a buffered junction, for --max-memory
+_JUNCTION_BYTES = 250
+
+
+def sj_records(path, count):
+    """Yield (chrom, start, end, strand, motif, reads) from an SJ.out.tab file."""
+    with open_text(path) as fh:
+        for line in fh:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < 8 or line.startswith('#'):
+                continue
+            uniq, multi = int(fields[6]), int(fields[7])
+            reads = uniq if count == 'unique' else (multi if count == 'multi' else uniq + multi)
+            yield fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[4]), reads
+
+
+def sort_sj(task):
+    """
+    Pool task: sort one SJ.out.tab by (chrom, start, end, strand) into a
+    temporary TSV. Returns (path of the sorted file, number of junctions).
+    """
+    path, out_path, count, max_items, tmp_dir = task
+    with ExternalSorter(max_items, tmpdir=tmp_dir) as sorter:
+        sorter.extend(sj_records(path, count))
+        n = 0
+        with open(out_path, 'w') as out:
+            for rec in sorter:
+                out.write('\t'.join(map(str, rec)) + '\n')
+                n += 1
+    return out_path, n
+
+
+def sorted_records(path, index):
+    """
+    Yield (key, motif, annotated, counts) from a file written by sort_sj();
+    index 0 is the annotated set, sample i is counted as ((i - 1, reads),).
+    """
+    with open(path) as fh:
+        for line in fh:
+            chrom, start, end, strand, motif, reads = line.rstrip('\n').split('\t')
+            key = (chrom, int(start), int(end), int(strand))
+            if index == 0:
+                yield key, int(motif), 1, ()
+            else:
+                yield key, int(motif), 0, ((index - 1, int(reads)),)
+
+
+def partial_records(path):
+    """Yield (key, motif, annotated, counts) from a file written by merge_group()."""
+    with open(path) as fh:
+        for line in fh:
+            chrom, start, end, strand, motif, annotated, counts = line.rstrip('\n').split('\t')
+            counts = tuple(tuple(map(int, pair.split(':'))) for pair in counts.split(','))
+            yield (chrom, int(start), int(end), int(strand)), int(motif), int(annotated), counts
+
+
+def merge_records(streams):
+    """
+    Merge (key, motif, annotated, counts) streams that are sorted by key.
+    Streams are passed in sample order, so ties come out in sample order and the
+    motif is taken from the annotated set, else from the first sample with the
+    junction. counts are sparse (sample, reads) pairs in sample order.
+    """
+    merged = heapq.merge(*streams, key=lambda item: item[0])
+    for key, group in itertools.groupby(merged, key=lambda item: item[0]):
+        motif = None
+        annotated = 0
+        counts = []
+        for _, rec_motif, rec_annotated, rec_counts in group:
+            if rec_annotated:
+                annotated = 1
+                motif = rec_motif
+            elif motif is None:
+                motif = rec_motif
+            counts.extend(rec_counts)
+        yield key, motif, annotated, counts
+
+
+def merge_group(paths, out_path, first):
+    """
+    Merge a contiguous group of sorted files into one partial file. paths are
+    sort_sj() outputs for samples first.. or earlier merge_group() outputs
+    (first is None).
+    """
+    if first is None:
+        streams = [partial_records(path) for path in paths]
+    else:
+        streams = [sorted_records(path, first + i) for i, path in enumerate(paths)]
+    with open(out_path, 'w') as out:
+        for (chrom, start, end, strand), motif, annotated, counts in merge_records(streams):
+            out.write(f"{chrom}\t{start}\t{end}\t{strand}\t{motif}\t{annotated}\t"
+                      + ','.join(f"{i}:{reads}" for i, reads in counts) + '\n')
+
+
+def max_open_files(reserve=64):
+    """Files merge_join() may open at once: the soft RLIMIT_NOFILE minus a reserve."""
+    if resource is None:
+        return 500
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 4096
+    return max(3, soft - reserve)
+
+
+def merge_join(sorted_paths, n_samples, fan_in, tmp_dir):
+    """
+    Merge-join the sorted annotated set (sorted_paths[0]) with the sorted
+    samples, opening at most fan_in files at a time: if there are more, the
+    samples are first merged in groups of fan_in into partial files under
+    tmp_dir, repeatedly. Yields (chrom, start, end, strand, motif, annotated,
+    counts).
+    """
+    annotated, rest = sorted_paths[0], sorted_paths[1:]
+    first = 1
+    level = 0
+    while len(rest) + 1 > fan_in:
+        groups = [rest[i:i + fan_in] for i in range(0, len(rest), fan_in)]
+        logging.info(f"Merging {len(rest)} files in {len(groups)} groups (--max-open-files {fan_in})...")
+        merged = []
+        for number, group in enumerate(groups):
+            out_path = str(Path(tmp_dir) / f"merge{level:02d}.{number:06d}.tsv")
+            merge_group(group, out_path, None if first is None else first + number * fan_in)
+            merged.append(out_path)
+        rest, first = merged, None
+        level += 1
+
+    streams = [sorted_records(annotated, 0)]
+    if first is None:
+        streams += [partial_records(path) for path in rest]
+    else:
+        streams += [sorted_records(path, first + i) for i, path in enumerate(rest)]
+    for key, motif, is_annotated, pairs in merge_records(streams):
+        counts = [0] * n_samples
+        for i, reads in pairs:
+            counts[i] += reads
+        yield key + (motif, is_annotated, counts)
+
+
+########
+# MAIN #
+########
+
+def main():
+    args = parse_args()
+
+    samples = read_samples(args)
+    for path in [args.annotated] + [path for _, path in samples]:
+        if not Path(path).is_file():
+            logging.error(f"File not found: {path}")
+            sys.exit(1)
+    names = [name for name, _ in samples]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        logging.error(f"Duplicate sample names (use --sj-list to name them): {', '.join(duplicated)}")
+        sys.exit(1)
+
+    threads = max(1, args.threads)
+    max_items = None
+    if args.max_memory:
+        max_items = max(1, args.max_memory // (threads * _JUNCTION_BYTES))
+
+    with tempfile.TemporaryDirectory(prefix='sjout2matrix.', dir=args.tmp_dir) as tmp:
+        # Sort every file by (chrom, start, end, strand); STAR writes its own chromosome order
+        tasks = [(path, str(Path(tmp) / f"{index:06d}.tsv"), args.count, max_items, args.tmp_dir)
+                 for index, path in enumerate([args.annotated] + [path for _, path in samples])]
+        logging.info(f"Sorting the annotated set and {len(samples)} SJ.out.tab files with {threads} workers...")
+        if threads > 1:
+            with multiprocessing.Pool(min(threads, len(tasks))) as pool:
+                sorted_files = pool.map(sort_sj, tasks)
+        else:
+            sorted_files = [sort_sj(task) for task in tasks]
+        logging.info(f"Annotated set: {sorted_files[0][1]} junctions")
+
+        # One pass over all sorted files, in groups if they cannot all be open at once
+        fan_in = args.max_open_files or max_open_files()
+        logging.info(f"Writing junction x sample matrix to: {args.out}")
+        n_rows = n_annotated = n_novel = 0
+        with open_output(args.out, args.threads) as out:
+            out.write('\t'.join(['chrom', 'start', 'end', 'strand', 'motif', 'annotated'] + names) + '\n')
+            for chrom, start, end, strand, motif, annotated, counts in merge_join(
+                    [path for path, _ in sorted_files], len(samples), fan_in, tmp):
+                observed = any(counts)
+                if args.observed_only and not observed:
+                    continue
+                out.write(f"{chrom}\t{start}\t{end}\t{strand}\t{motif}\t{annotated}\t"
+                          + '\t'.join(map(str, counts)) + '\n')
+                n_rows += 1
+                if observed:
+                    if annotated:
+                        n_annotated += 1
+                    else:
+                        n_novel += 1
+
+    logging.info(
+        f"Done. samples={len(samples)} junctions={n_rows} "
+        f"observed_annotated={n_annotated} observed_novel={n_novel}"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Tests for omics_toolkit.annotation.
+
+The files in data/expected/ were written by the per-script parsers that the
+package replaced: parse_gtf/parse_bed12 from annots2sjout.py,
+parse_gtf_transcript_bounds/parse_bed12_transcript_bounds from
+annots2transcript-ends.py and get_genes_gff from get-nucdiff-variants.py.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib', 'python'))
+from omics_toolkit.annotation import (
+    gtf_stream_problem,
+    gtf_transcripts,
+    read_bed12,
+    read_gff,
+    read_gff_sequences,
+    read_gtf,
+    UnsortedGTFError,
+)
+
+DATA = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+
+def data(name):
+    return os.path.join(DATA, name)
+
+
+def expected(name):
+    with open(os.path.join(DATA, 'expected', name)) as fh:
+        return [tuple(line.rstrip('\n').split('\t')) for line in fh]
+
+
+def exons(pairs):
+    return ','.join(f"{s}-{e}" for s, e in sorted(pairs))
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('path, name', [
+    ('quotes.gtf', 'quotes'),
+    ('quotes.gtf.gz', 'quotes'),
+    ('exonset.gtf', 'exonset'),
+])
+def test_gtf_transcripts_exons(path, name, stream):
+    # annots2sjout.py: exonset genes need exon_number
+    got = [(tx.chrom, tx.strand, exons(tx.exons)) for tx in gtf_transcripts(data(path), stream=stream)]
+    assert got == expected(f'{name}.transcripts.tsv')
+
+
+@pytest.mark.parametrize('stream', [False, True])
+@pytest.mark.parametrize('path, name', [
+    ('quotes.gtf', 'quotes'),
+    ('quotes.gtf.gz', 'quotes'),
+    ('exonset.gtf', 'exonset'),
+])
+def test_gtf_transcripts_bounds(path, name, stream):
+    # annots2transcript-ends.py: any exon with a gene_id forms an exonset
+    txs = gtf_transcripts(data(path), stream=stream, gene_ids=True, exonset_needs_number=False)
+    got = [(tx.chrom, tx.txid, tx.strand, str(tx.min_start), str(tx.max_end), tx.gene_id or '.') for tx in txs]
+    assert got == expected(f'{name}.bounds.tsv')
+
+
+def test_gtf_quotes():
+    records = [rec for rec in read_gtf(data('quotes.gtf'), features={'exon'}) if rec.transcript_id == 'T2']
+    assert [rec.gene_id for rec in records] == ['G2', 'G2', 'G2', 'G3']
+    assert records[0].attributes == {'transcript_id': 'T2', 'gene_id': 'G2'}
+
+
+def test_gtf_stream_problem(tmp_path):
+    assert gtf_stream_problem(data('quotes.gtf')) is None
+    assert gtf_stream_problem(data('exonset.gtf')) is None
+
+    # Position-sorted: B starts in the intron of A
+    rows = [(100, 200, 'A'), (250, 350, 'B'), (300, 400, 'A'), (500, 600, 'B')]
+    lines = [f'chr1\tt\texon\t{s}\t{e}\t.\t+\t.\tgene_id "G"; transcript_id "{txid}";\n'
+             for s, e, txid in rows]
+    path = tmp_path / 'sorted.gtf'
+    path.write_text(''.join(lines))
+    assert 'A' in gtf_stream_problem(str(path))
+    with pytest.raises(UnsortedGTFError):
+        list(gtf_transcripts(str(path), stream=True))
+
+    # The same with 'transcript' records streams fine
+    spans = ['chr1\tt\ttranscript\t100\t400\t.\t+\t.\tgene_id "G"; transcript_id "A";\n',
+             'chr1\tt\ttranscript\t250\t600\t.\t+\t.\tgene_id "G"; transcript_id "B";\n']
+    path.write_text(spans[0] + lines[0] + spans[1] + ''.join(lines[1:]))
+    assert gtf_stream_problem(str(path)) is None
+    assert [tx.txid for tx in gtf_transcripts(str(path), stream=True)] == ['A', 'B']
+
+
+def test_bed12_blocks():
+    got = [(rec.chrom, rec.strand, exons(rec.exons_1b()))
+           for rec in read_bed12(data('transcripts.bed12')) if rec.exons_1b() is not None]
+    assert got == expected('transcripts.blocks.tsv')
+
+
+def test_bed12_bounds():
+    got = [(rec.chrom, rec.strand, str(rec.start), str(rec.end), rec.name)
+           for rec in read_bed12(data('transcripts.bed12'))]
+    assert got == expected('transcripts.bounds.tsv')
+
+
+def test_gff_with_fasta():
+    got = [(rec.chrom, str(rec.start), str(rec.end), rec.strand, rec.get('Name', 'none'),
+            rec.get('locus_tag', 'none'), 'none', rec.get('product', 'none'), 'none')
+           for rec in read_gff(data('prokka.gff'), features={'CDS'})]
+    assert got == expected('prokka.genes.tsv')
+    assert sorted(read_gff_sequences(data('prokka.gff')).items()) == expected('prokka.sequences.tsv')
@@ -0,0 +1,69 @@
+"""
+Tests for omics_toolkit.columnar, with pyarrow and with the pandas fallback.
+
+The expected files are the ones test_annotation.py checks gtf_transcripts()
+against, so both back ends must agree with the python engine.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib', 'python'))
+from omics_toolkit import columnar
+from omics_toolkit.columnar import gtf_intron_table, gtf_transcript_table
+
+DATA = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+
+
+def data(name):
+    return os.path.join(DATA, name)
+
+
+def expected(name):
+    with open(os.path.join(DATA, 'expected', name)) as fh:
+        return [tuple(line.rstrip('\n').split('\t')) for line in fh]
+
+
+def introns(rows):
+    # (chrom, strand, "s-e,s-e,...") transcripts to introns, like introns_from_exons()
+    result = []
+    for chrom, strand, exons in rows:
+        pairs = [tuple(map(int, pair.split('-'))) for pair in exons.split(',')]
+        for (_, prev_end), (start, _) in zip(pairs, pairs[1:]):
+            if start - 1 >= prev_end + 1:
+                result.append((chrom, strand, prev_end + 1, start - 1))
+    return result
+
+
+@pytest.fixture(params=['pyarrow', 'pandas'])
+def engine(request, monkeypatch):
+    if request.param == 'pyarrow' and columnar.pa is None:
+        pytest.skip('pyarrow is not installed')
+    if request.param == 'pandas':
+        monkeypatch.setattr(columnar, 'pa', None)
+    return request.param
+
+
+@pytest.mark.parametrize('path, name', [
+    ('quotes.gtf', 'quotes'),
+    ('quotes.gtf.gz', 'quotes'),
+    ('exonset.gtf', 'exonset'),
+])
+def test_gtf_intron_table(engine, path, name):
+    table = gtf_intron_table(data(path), chunksize=4)
+    got = list(zip(table['chrom'], table['strand'], table['start'].tolist(), table['end'].tolist()))
+    assert got == introns(expected(f'{name}.transcripts.tsv'))
+
+
+@pytest.mark.parametrize('path, name', [
+    ('quotes.gtf', 'quotes'),
+    ('quotes.gtf.gz', 'quotes'),
+    ('exonset.gtf', 'exonset'),
+])
+def test_gtf_transcript_table(engine, path, name):
+    table = gtf_transcript_table(data(path), gene_ids=True, exonset_needs_number=False, chunksize=4)
+    got = [(chrom, txid, strand, str(start), str(end), gene_id or '.')
+           for chrom, txid, strand, start, end, gene_id in table.itertuples(index=False)]
+    assert got == expected(f'{name}.bounds.tsv')
@@ -0,0 +1,54 @@
+"""
+Tests for omics_toolkit.extsort.
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib', 'python'))
+from omics_toolkit.extsort import ExternalSorter, RunFiles
+
+
+def test_sorter_matches_sorted(tmp_path):
+    rng = random.Random(1)
+    items = [(rng.randrange(50), rng.randrange(3)) for _ in range(2000)]
+    with ExternalSorter(max_items=7, key=lambda item: item[0], tmpdir=str(tmp_path)) as sorter:
+        sorter.extend(items)
+        # 285 spills merge in levels: fewer than MAX_RUNS runs per level remain
+        assert sorter.n_runs < 3 * RunFiles.MAX_RUNS
+        got = list(sorter)
+    want = []
+    for item in sorted(items, key=lambda item: item[0]):
+        if not want or item != want[-1]:
+            want.append(item)
+    assert got == want
+    assert os.listdir(tmp_path) == []
+
+
+def test_run_levels(tmp_path):
+    merged = []
+
+    def merge(paths, out_path):
+        merged.append(len(paths))
+        with open(out_path, 'w') as out:
+            for path in paths:
+                with open(path) as fh:
+                    out.write(fh.read())
+
+    runs = RunFiles(merge, tmpdir=str(tmp_path), max_runs=3)
+    for i in range(14):
+        path = runs.new_path()
+        with open(path, 'w') as fh:
+            fh.write(f"{i}\n")
+        runs.add(path)
+    # 14 = 9 + 3 + 2: one run of level 2, one of level 1 and two of level 0
+    assert len(runs) == 4
+    assert merged == [3, 3, 3, 3, 3]
+    content = ''
+    for path in runs.paths:
+        with open(path) as fh:
+            content += fh.read()
+    assert content.split() == [str(i) for i in range(14)]
+    runs.clear()
+    assert os.listdir(tmp_path) == []